@@ -0,0 +1,154 @@
+"""completion backends for ChatSession: the anthropic api, and a recorder
+and replayer so sessions can be rerun offline with their original timing"""
+
+import asyncio
+import dataclasses
+import hashlib
+import json
+import time
+import typing
+
+import anthropic
+
+from . import metrics
+
+
+class Backend(typing.Protocol):
+    """streams the model's reply to a conversation"""
+
+    def stream(self, messages: list[dict], system: str) -> typing.AsyncIterator[str]:
+        ...
+
+
+def request_digest(messages: list[dict], system: str) -> str:
+    """identifies a request so a replay can find its recorded reply"""
+    data = json.dumps({"system": system, "messages": messages}, sort_keys=True)
+    return hashlib.sha256(data.encode()).hexdigest()
+
+
+class AnthropicBackend:
+    """completions from the anthropic messages api"""
+    client: anthropic.AsyncAnthropic
+    model: str
+    max_tokens: int
+
+    def __init__(self, client: anthropic.AsyncAnthropic,
+                 model: str = "claude-3-opus-20240229", max_tokens: int = 4096):
+        self.client = client
+        self.model = model
+        self.max_tokens = max_tokens
+
+    async def stream(self, messages: list[dict], system: str) -> typing.AsyncIterator[str]:
+        start = time.perf_counter()
+        async with self.client.messages.stream(
+            model=self.model,
+            max_tokens=self.max_tokens,
+            messages=messages,
+            system=system,
+        ) as stream:
+            async for text in stream.text_stream:
+                yield text
+            if metrics.REGISTRY.enabled:
+                message = await stream.get_final_message()
+                metrics.observe("model_output_tokens_per_second",
+                                message.usage.output_tokens / (time.perf_counter() - start))
+
+
+@dataclasses.dataclass
+class Exchange:
+    """one recorded request and the chunks that answered it. each chunk
+    is (seconds since the previous chunk or the request, text)"""
+    digest: str
+    prompt: str
+    chunks: list[tuple[float, str]]
+
+    def to_json(self) -> dict:
+        return dataclasses.asdict(self)
+
+    @classmethod
+    def from_json(cls, data: dict) -> "Exchange":
+        return cls(data["digest"], data["prompt"], [tuple(chunk) for chunk in data["chunks"]])
+
+
+def load_cassette(path: str) -> list[Exchange]:
+    """read the exchanges recorded in a cassette file"""
+    with open(path) as file:
+        return [Exchange.from_json(json.loads(line)) for line in file if line.strip()]
+
+
+def save_cassette(path: str, exchanges: list[Exchange]):
+    with open(path, "w") as file:
+        for exchange in exchanges:
+            file.write(json.dumps(exchange.to_json()) + "\n")
+
+
+class RecordingBackend:
+    """passes requests through to another backend and appends every
+    completed exchange, with its inter-chunk timing, to a cassette.
+    recording outside a scheduler.ScheduledBackend keeps one exchange per
+    request however many retries it took. the time it reports in waited,
+    queueing and backoff, is left out of the timing so a replay shows
+    the model's own speed"""
+    backend: Backend
+    path: str
+
+    def __init__(self, backend: Backend, path: str):
+        self.backend = backend
+        self.path = path
+
+    async def stream(self, messages: list[dict], system: str) -> typing.AsyncIterator[str]:
+        chunks = []
+        last = time.perf_counter()
+        waited = getattr(self.backend, "waited", 0.0)
+        async for text in self.backend.stream(messages, system):
+            now = time.perf_counter()
+            scheduled = getattr(self.backend, "waited", 0.0) - waited
+            chunks.append((max(0.0, now - last - scheduled), text))
+            last = now
+            waited += scheduled
+            yield text
+        exchange = Exchange(request_digest(messages, system), messages[-1]["content"], chunks)
+        with open(self.path, "a") as file:
+            file.write(json.dumps(exchange.to_json()) + "\n")
+
+
+class ReplayExhausted(Exception):
+    """the replay was asked for more exchanges than were recorded"""
+
+
+class ReplayBackend:
+    """answers requests from a cassette. a request is matched to the
+    exchange recorded for the identical request if there is one, and
+    otherwise to the next unused exchange in recording order, so a replay
+    survives small differences such as temp paths in tool output.
+
+    speed scales the recorded timing: 1 replays in real time, 10 ten
+    times faster, and None as fast as possible"""
+    exchanges: list[Exchange]
+    speed: float|None
+    used: set[int]
+
+    def __init__(self, exchanges: list[Exchange], speed: float|None = 1.0):
+        self.exchanges = exchanges
+        self.speed = speed
+        self.used = set()
+
+    @classmethod
+    def from_file(cls, path: str, speed: float|None = 1.0) -> "ReplayBackend":
+        return cls(load_cassette(path), speed)
+
+    def _next(self, messages: list[dict], system: str) -> Exchange:
+        digest = request_digest(messages, system)
+        unused = [n for n in range(len(self.exchanges)) if n not in self.used]
+        if not unused:
+            raise ReplayExhausted(f"all {len(self.exchanges)} recorded exchanges have been replayed")
+        match = next((n for n in unused if self.exchanges[n].digest == digest), unused[0])
+        self.used.add(match)
+        return self.exchanges[match]
+
+    async def stream(self, messages: list[dict], system: str) -> typing.AsyncIterator[str]:
+        exchange = self._next(messages, system)
+        for delay, text in exchange.chunks:
+            if self.speed is not None:
+                await asyncio.sleep(delay / self.speed)
+            yield text
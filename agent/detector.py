@@ -64,7 +64,7 @@ class Tokenizer:
         return f"<Tokenizer {self.value!r}, {self.offset!r}, {self.state}>"
     
     def looking_at(self, v):
-        return self.value[self.offset:].startswith(v)
+        return self.value.startswith(v, self.offset)
     
     def consume(self, v):
         if self.looking_at(v):
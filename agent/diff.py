@@ -0,0 +1,70 @@
+"""line diffs that stay cheap on large or machine generated files"""
+
+import difflib
+
+
+# above this many lines in the changed region a diff is not worth
+# computing or reading, so we summarize the change instead
+MAX_DIFF_LINES = 2000
+
+
+def _range(start: int, length: int) -> str:
+    # unified diff line ranges are 1 based, and an empty range names the
+    # line before it
+    if length == 1:
+        return f"{start + 1}"
+    if not length:
+        start -= 1
+    return f"{start + 1},{length}"
+
+
+def unified_diff(before: str, after: str, fromfile: str = "before",
+                 tofile: str = "after", context: int = 3,
+                 max_lines: int = MAX_DIFF_LINES) -> str:
+    """a unified diff of two texts, or a one line summary when the
+    changed region is longer than max_lines"""
+    a = before.split("\n")
+    b = after.split("\n")
+
+    # the common prefix and suffix can't be part of any change, and
+    # trimming them first keeps the quadratic part of the matcher small
+    prefix = 0
+    limit = min(len(a), len(b))
+    while prefix < limit and a[prefix] == b[prefix]:
+        prefix += 1
+    suffix = 0
+    limit -= prefix
+    while suffix < limit and a[-1 - suffix] == b[-1 - suffix]:
+        suffix += 1
+
+    a_changed = len(a) - prefix - suffix
+    b_changed = len(b) - prefix - suffix
+    if not a_changed and not b_changed:
+        return ""
+    if max(a_changed, b_changed) > max_lines:
+        return (f"changes span {a_changed} lines starting at line {prefix + 1} "
+                f"({len(a)} lines before, {len(b)} after), too large to show as a diff")
+
+    # keep enough of the common text around the change for context
+    start = max(0, prefix - context)
+    a_end = len(a) - max(0, suffix - context)
+    b_end = len(b) - max(0, suffix - context)
+    # autojunk stays on: without it repetitive machine generated text
+    # makes the matcher quadratic in the size of the changed region
+    matcher = difflib.SequenceMatcher(None, a[start:a_end], b[start:b_end])
+
+    lines = [f"--- {fromfile}", f"+++ {tofile}"]
+    for group in matcher.get_grouped_opcodes(context):
+        first, last = group[0], group[-1]
+        a_range = _range(start + first[1], last[2] - first[1])
+        b_range = _range(start + first[3], last[4] - first[3])
+        lines.append(f"@@ -{a_range} +{b_range} @@")
+        for tag, i1, i2, j1, j2 in group:
+            if tag == "equal":
+                lines.extend(" " + line for line in a[start + i1:start + i2])
+                continue
+            if tag in ("replace", "delete"):
+                lines.extend("-" + line for line in a[start + i1:start + i2])
+            if tag in ("replace", "insert"):
+                lines.extend("+" + line for line in b[start + j1:start + j2])
+    return "\n".join(lines)
@@ -0,0 +1,67 @@
+"""stand-ins for the model backend and the docker shell so the agent
+loop can be exercised without an api key or docker"""
+
+import asyncio
+import dataclasses
+import threading
+import typing
+
+from . import shell
+
+
+class FakeBackend:
+    """a completion backend whose replies come from respond, a function
+    of the messages sent. replies are streamed a word at a time with
+    delay seconds before each word"""
+    respond: typing.Callable[[list[dict]], str]
+    delay: float
+    requests: list[list[dict]]
+    in_flight: int
+    peak_in_flight: int
+
+    def __init__(self, respond: typing.Callable[[list[dict]], str], delay: float = 0.0):
+        self.respond = respond
+        self.delay = delay
+        self.requests = []
+        self.in_flight = 0
+        self.peak_in_flight = 0
+
+    async def stream(self, messages: list[dict], system: str) -> typing.AsyncIterator[str]:
+        self.requests.append(messages)
+        words = self.respond(messages).split(" ")
+        self.in_flight += 1
+        self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+        try:
+            for n, word in enumerate(words):
+                await asyncio.sleep(self.delay)
+                yield word if n == len(words) - 1 else word + " "
+        finally:
+            self.in_flight -= 1
+
+
+@dataclasses.dataclass
+class FakeShell:
+    """a shell that records commands and answers them from outputs.
+    commands in hang never finish on their own, they return once
+    interrupted or timed out, as Shell.run does"""
+    outputs: dict[str, shell.ShellResponse] = dataclasses.field(default_factory=dict)
+    commands: list[str] = dataclasses.field(default_factory=list)
+    hang: set[str] = dataclasses.field(default_factory=set)
+    interrupts: int = 0
+    interrupted: threading.Event = dataclasses.field(default_factory=threading.Event)
+
+    def run(self, line: str, timeout=-1) -> shell.ShellResponse:
+        self.commands.append(line)
+        if line in self.hang:
+            interrupted = self.interrupted.wait(None if timeout in (-1, None) else timeout)
+            self.interrupted.clear()
+            note = "" if interrupted else f"\n[interrupted after {timeout} seconds]"
+            return shell.ShellResponse(f"^C{note}", 130)
+        return self.outputs.get(line, shell.ShellResponse("", 0))
+
+    def interrupt(self):
+        self.interrupts += 1
+        self.interrupted.set()
+
+    def close(self):
+        pass
@@ -0,0 +1,190 @@
+"""run several attempts at a prompt at once and keep the best
+
+fan_out forks a StatefulChat into branches, each with a copy of the
+workspace, the transcript and its own shell. the branches run the prompt
+concurrently, are scored by running the tests in each, and the winner's
+workspace changes and transcript are merged back into the original chat.
+with stop_at_green the first branch whose tests pass wins and the others
+are cancelled"""
+
+import asyncio
+import copy
+import dataclasses
+import os
+import re
+import shutil
+import tempfile
+import time
+import typing
+
+from . import backend
+from . import fsutil
+from . import llm
+from . import metrics
+from . import observations
+from . import shell
+from . import snapshot
+
+
+# pytest's closing summary, e.g. "3 failed, 12 passed in 0.51s"
+SUMMARY = re.compile(r"(\d+) (passed|failed|errors?)\b")
+
+
+def score(result: shell.ShellResponse) -> tuple[bool, int, int]:
+    """rank a test run, higher is better: all passing first, then the
+    most tests passing, then the fewest failing"""
+    counts = {}
+    for count, kind in SUMMARY.findall(result.output):
+        counts[kind.rstrip("s")] = int(count)
+    failed = counts.get("failed", 0) + counts.get("error", 0)
+    return (result.return_code == 0, counts.get("passed", 0), -failed)
+
+
+@dataclasses.dataclass
+class Branch:
+    """one attempt at the prompt and how it went"""
+    number: int
+    chat: llm.StatefulChat
+    output: str = ""
+    tests: shell.ShellResponse|None = None
+    seconds: float = 0.0
+    error: Exception|None = None
+
+    @property
+    def passed(self) -> bool:
+        return self.tests is not None and self.tests.return_code == 0
+
+    def rank(self) -> tuple:
+        return (score(self.tests), -self.seconds)
+
+
+def fork(chat: llm.StatefulChat, number: int, directory: str,
+         completions: backend.Backend,
+         make_shell: typing.Callable[[str], shell.Shell]|None = None) -> Branch:
+    """copy chat's workspace and transcript into directory/branch-{number}"""
+    workspace = os.path.join(directory, f"branch-{number}")
+    shutil.copytree(chat.base_path, workspace, ignore=shutil.ignore_patterns(
+        snapshot.STORE_DIR, llm.STAGING_DIR, "transcript.json",
+    ))
+    forked = llm.StatefulChat(
+        system_prompt=chat.chat.system,
+        base_path=workspace,
+        completions=completions,
+        sh=make_shell(workspace) if make_shell else None,
+        limits=chat.limits,
+        tool_timeout=chat.tool_timeout,
+        turn_timeout=chat.turn_timeout,
+    )
+    forked.chat.transcript = copy.deepcopy(chat.chat.transcript)
+    forked.chat.blobs = observations.BlobStore(dict(chat.chat.blobs.blobs))
+    return Branch(number, forked)
+
+
+def merge(chat: llm.StatefulChat, branch: Branch) -> list[str]:
+    """make chat's workspace and transcript those of branch. returns the
+    paths that changed"""
+    source = branch.chat
+    before = source.snapshots.load(0).files
+    after = source.snapshots.scan()
+    changed = []
+    for rel_path, entry in after.items():
+        previous = before.get(rel_path)
+        if previous is not None and previous.blob == entry.blob:
+            continue
+        with fsutil.atomic_replace(os.path.join(chat.base_path, rel_path), entry.mode) as tmp_path:
+            shutil.copyfile(os.path.join(source.base_path, rel_path), tmp_path)
+        changed.append(rel_path)
+    for rel_path in before.keys() - after.keys():
+        try:
+            os.unlink(os.path.join(chat.base_path, rel_path))
+        except FileNotFoundError:
+            pass
+        changed.append(rel_path)
+    chat.index.refresh()
+
+    # tool output names files by their path in the branch's workspace
+    def relocate(value: str) -> str:
+        return value.replace(source.base_path, chat.base_path)
+
+    chat.chat.transcript = [
+        {**message, "content": relocate(message["content"]) if isinstance(message["content"], str) else [
+            {**part, "text": relocate(part["text"])} if part["type"] == "text" else part
+            for part in message["content"]
+        ]}
+        for message in source.chat.transcript
+    ]
+    chat.chat.blobs = source.chat.blobs
+    chat.chat.save()
+    return sorted(changed)
+
+
+async def run(branch: Branch, prompt: str) -> Branch:
+    """run the prompt in a branch and then its tests"""
+    start = time.perf_counter()
+    try:
+        with metrics.span("fanout_branch"):
+            async for text in branch.chat.interact(prompt):
+                branch.output += text
+            # no need to run the tests again if nothing changed since
+            # the model last checked them
+            branch.tests = branch.chat.tests or await branch.chat.interruptible(branch.chat.run_shell, llm.TEST_COMMAND)
+    except Exception as exc:
+        # one broken branch shouldn't take the others down
+        branch.error = exc
+    branch.seconds = time.perf_counter() - start
+    return branch
+
+
+async def fan_out(chat: llm.StatefulChat, prompt: str, branches: int = 3,
+                  make_completions: typing.Callable[[int], backend.Backend]|None = None,
+                  make_shell: typing.Callable[[str], shell.Shell]|None = None,
+                  stop_at_green: bool = True) -> list[Branch]:
+    """run prompt in branches forks of chat at once and merge the best
+    into chat as its next turn. returns the branches that finished, best
+    first. make_completions gives branch n its backend, by default they
+    share chat's. make_shell starts a branch's shell, by default a new
+    isolation container. a losing branch still running its tests is
+    interrupted before it is closed"""
+    if branches < 1:
+        raise ValueError(f"fan out needs at least one branch, not {branches}")
+    make_completions = make_completions or (lambda number: chat.chat.backend)
+    # next to the workspace, not inside it, so it isn't indexed or copied
+    directory = tempfile.mkdtemp(prefix=".fanout-", dir=os.path.dirname(os.path.abspath(chat.base_path)))
+    forking = [
+        asyncio.ensure_future(asyncio.to_thread(fork, chat, number, directory, make_completions(number), make_shell))
+        for number in range(branches)
+    ]
+    tasks = []
+    try:
+        await asyncio.wait(forking)
+        # one that failed to start, e.g. its container, fails the fan out
+        forks = [job.result() for job in forking]
+        tasks = [asyncio.ensure_future(run(branch, prompt)) for branch in forks]
+        for finished in asyncio.as_completed(tasks):
+            branch = await finished
+            if stop_at_green and branch.passed:
+                break
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+        ranked = sorted((branch for branch in forks if branch.tests is not None), key=Branch.rank, reverse=True)
+        if not ranked:
+            raise next(branch.error for branch in forks if branch.error is not None)
+        await asyncio.to_thread(merge, chat, ranked[0])
+        chat.turn += 1
+        await asyncio.to_thread(
+            chat.snapshots.snapshot, chat.turn, transcript_length=len(chat.chat.transcript),
+        )
+        return ranked
+    finally:
+        # stop the branches, also when we were cancelled, before their
+        # shells and workspaces go away under them
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await asyncio.wait(forking)
+        for job in forking:
+            if not job.cancelled() and job.exception() is None:
+                await asyncio.to_thread(job.result().chat.close)
+        await asyncio.to_thread(shutil.rmtree, directory, ignore_errors=True)
@@ -0,0 +1,71 @@
+"""filesystem helpers shared by the workspace tools"""
+
+import contextlib
+import os
+import tempfile
+import typing
+
+
+def walk_files(root: str, ignore: set[str]|None = None) -> typing.Iterator[tuple[str, os.stat_result]]:
+    """yield (relative path, stat) for every regular file below root,
+    skipping hidden files and directories and any relative path in ignore"""
+    ignore = ignore or set()
+    stack = [root]
+    while stack:
+        directory = stack.pop()
+        try:
+            entries = list(os.scandir(directory))
+        except FileNotFoundError:
+            continue
+        for entry in entries:
+            if entry.name.startswith("."):
+                continue
+            if entry.is_dir(follow_symlinks=False):
+                stack.append(entry.path)
+            elif entry.is_file(follow_symlinks=False):
+                rel_path = os.path.relpath(entry.path, root)
+                if rel_path in ignore:
+                    continue
+                yield rel_path, entry.stat()
+
+
+@contextlib.contextmanager
+def atomic_replace(path: str, mode: int|None = None) -> typing.Iterator[str]:
+    """yield a temporary path next to path. when the block completes the
+    temporary file atomically replaces path, so concurrent readers see
+    either the old file or the new one but never a partial write. if the
+    block raises the temporary file is discarded. the new file keeps the
+    mode of the one it replaces unless mode is given"""
+    directory = os.path.dirname(path) or "."
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".tmp-")
+    os.close(fd)
+    try:
+        yield tmp_path
+        replace_with(tmp_path, path, mode)
+    except BaseException:
+        try:
+            os.unlink(tmp_path)
+        except FileNotFoundError:
+            pass
+        raise
+
+
+def replace_with(tmp_path: str, path: str, mode: int|None = None):
+    """atomically move tmp_path, which must be on the same filesystem, to
+    path. it keeps the mode of the file it replaces unless mode is given"""
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    if mode is None:
+        try:
+            mode = os.stat(path).st_mode & 0o777
+        except FileNotFoundError:
+            mode = 0o644
+    os.chmod(tmp_path, mode)
+    os.replace(tmp_path, path)
+
+
+def atomic_write(path: str, content: str):
+    """write content to path via atomic_replace"""
+    with atomic_replace(path) as tmp_path:
+        with open(tmp_path, "w") as file:
+            file.write(content)
@@ -0,0 +1,238 @@
+"""trigram inverted index over a workspace for fast text, regex and
+identifier search"""
+
+import dataclasses
+import os
+import re
+
+try:
+    import re._parser as sre_parse
+    import re._constants as sre_constants
+except ImportError:  # python 3.10
+    import sre_parse
+    import sre_constants
+
+from . import fsutil
+
+
+# files larger than this are not indexed (generated data, lock files, ...)
+MAX_FILE_SIZE = 1 << 20
+
+
+def trigrams(text: str) -> set[str]:
+    """the case folded trigrams of each line of text. search is line
+    oriented so trigrams spanning a newline are never needed"""
+    result = set()
+    for line in set(text.lower().splitlines()):
+        result.update(map("".join, zip(line, line[1:], line[2:])))
+    return result
+
+
+def required_literals(pattern: str, flags: int = 0) -> list[str]:
+    """literal substrings that every match of the regex must contain.
+    this is conservative: anything we don't understand ends a literal run
+    and an alternation at the top level yields no literals at all"""
+    try:
+        parsed = sre_parse.parse(pattern, flags)
+    except re.error:
+        return []
+    return _literals(parsed)
+
+
+def _literals(parsed) -> list[str]:
+    literals = []
+    current = ""
+    for op, arg in parsed:
+        if op is sre_constants.LITERAL:
+            current += chr(arg)
+            continue
+        if current:
+            literals.append(current)
+            current = ""
+        if op is sre_constants.SUBPATTERN:
+            # (group) - the group's own literals are required too
+            literals.extend(_literals(arg[-1]))
+        elif op in (sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT):
+            low, _, subpattern = arg
+            if low >= 1:
+                literals.extend(_literals(subpattern))
+    if current:
+        literals.append(current)
+    return literals
+
+
+@dataclasses.dataclass
+class FileEntry:
+    """what we know about an indexed file"""
+    mtime_ns: int
+    size: int
+    trigrams: frozenset[str]
+
+
+@dataclasses.dataclass
+class SearchHit:
+    """a single matching line"""
+    path: str
+    line: int
+    text: str
+    before: list[str]
+    after: list[str]
+
+    def __str__(self):
+        result = ""
+        first = self.line - len(self.before)
+        for offset, text in enumerate(self.before):
+            result += f"{self.path}-{first + offset}- {text}\n"
+        result += f"{self.path}:{self.line}: {self.text}\n"
+        for offset, text in enumerate(self.after):
+            result += f"{self.path}-{self.line + 1 + offset}- {text}\n"
+        return result
+
+
+class WorkspaceIndex:
+    """an inverted index from trigrams to the files containing them.
+    the index is kept current incrementally: update() reindexes a
+    single file and refresh() reindexes only files whose size or
+    modification time changed since they were last seen"""
+    root: str
+    ignore: set[str]
+    files: dict[str, FileEntry]
+    postings: dict[str, set[str]]
+
+    def __init__(self, root: str, ignore: set[str]|None = None):
+        self.root = root
+        self.ignore = ignore or set()
+        self.files = {}
+        self.postings = {}
+
+    def _read(self, rel_path: str) -> str|None:
+        """the text of a file, or None if it is missing or binary"""
+        try:
+            with open(os.path.join(self.root, rel_path), "rb") as file:
+                data = file.read(MAX_FILE_SIZE + 1)
+        except (FileNotFoundError, IsADirectoryError):
+            return None
+        if len(data) > MAX_FILE_SIZE or b"\0" in data[:8192]:
+            return None
+        try:
+            return data.decode()
+        except UnicodeDecodeError:
+            return None
+
+    def _remove(self, rel_path: str):
+        entry = self.files.pop(rel_path, None)
+        if entry is None:
+            return
+        for trigram in entry.trigrams:
+            paths = self.postings.get(trigram)
+            if paths is not None:
+                paths.discard(rel_path)
+                if not paths:
+                    del self.postings[trigram]
+
+    def _add(self, rel_path: str, stat: os.stat_result, text: str|None):
+        grams = frozenset(trigrams(text)) if text is not None else frozenset()
+        self.files[rel_path] = FileEntry(stat.st_mtime_ns, stat.st_size, grams)
+        postings = self.postings
+        for trigram in grams:
+            paths = postings.get(trigram)
+            if paths is None:
+                postings[trigram] = {rel_path}
+            else:
+                paths.add(rel_path)
+
+    def update(self, rel_path: str, text: str|None = None):
+        """reindex a single file, e.g. right after it was written. text
+        may be supplied to avoid reading the file back"""
+        rel_path = os.path.normpath(rel_path)
+        self._remove(rel_path)
+        try:
+            stat = os.stat(os.path.join(self.root, rel_path))
+        except FileNotFoundError:
+            return
+        if text is None or stat.st_size > MAX_FILE_SIZE:
+            text = self._read(rel_path)
+        self._add(rel_path, stat, text)
+
+    def refresh(self) -> int:
+        """bring the index up to date with the workspace, reindexing only
+        files that changed. returns the number of files reindexed"""
+        seen = set()
+        changed = 0
+        for rel_path, stat in fsutil.walk_files(self.root, self.ignore):
+            seen.add(rel_path)
+            entry = self.files.get(rel_path)
+            if entry is not None and entry.mtime_ns == stat.st_mtime_ns and entry.size == stat.st_size:
+                continue
+            self._remove(rel_path)
+            self._add(rel_path, stat, self._read(rel_path))
+            changed += 1
+        for rel_path in list(self.files.keys() - seen):
+            self._remove(rel_path)
+            changed += 1
+        return changed
+
+    def candidates(self, literals: list[str]) -> list[str]:
+        """files that contain every trigram of every literal"""
+        grams = set()
+        for literal in literals:
+            grams |= trigrams(literal)
+        if not grams:
+            return sorted(self.files)
+        result = None
+        # intersect the rarest postings first so the working set stays small
+        for trigram in sorted(grams, key=lambda gram: len(self.postings.get(gram, ()))):
+            paths = self.postings.get(trigram)
+            if not paths:
+                return []
+            result = set(paths) if result is None else result & paths
+            if not result:
+                return []
+        return sorted(result)
+
+    def search(self, pattern: str, kind: str = "text", context: int = 1,
+               max_results: int = 50) -> list[SearchHit]:
+        """find lines matching pattern. kind is one of
+        - text: a case sensitive literal substring
+        - regex: a python regular expression
+        - identifier: a whole word, with definitions sorted first"""
+        if kind == "text":
+            matcher = re.compile(re.escape(pattern))
+            literals = [pattern]
+        elif kind == "regex":
+            matcher = re.compile(pattern)
+            literals = required_literals(pattern)
+        elif kind == "identifier":
+            matcher = re.compile(rf"\b{re.escape(pattern)}\b")
+            literals = [pattern]
+        else:
+            raise ValueError(f"unknown search kind {kind}, expected text, regex or identifier")
+
+        hits = []
+        for rel_path in self.candidates(literals):
+            text = self._read(rel_path)
+            if text is None:
+                continue
+            lines = text.splitlines()
+            for number, line in enumerate(lines):
+                if not matcher.search(line):
+                    continue
+                hits.append(SearchHit(
+                    path=rel_path,
+                    line=number + 1,
+                    text=line,
+                    before=lines[max(0, number - context):number],
+                    after=lines[number + 1:number + 1 + context],
+                ))
+            # identifier hits are reordered below so they need the full set
+            if kind != "identifier" and len(hits) >= max_results:
+                break
+
+        if kind == "identifier":
+            definition = re.compile(
+                rf"^\s*(?:(?:async\s+)?def|class)\s+{re.escape(pattern)}\b"
+                rf"|^\s*{re.escape(pattern)}\s*(?::[^=]*)?=[^=]"
+            )
+            # stable sort keeps path/line order within each group
+            hits.sort(key=lambda hit: definition.search(hit.text) is None)
+        return hits[:max_results]
@@ -1,45 +1,157 @@
 """provide completions via vertex ai"""
+import asyncio
+import contextlib
+import dataclasses
 import os
+import threading
+import time
 import typing
 import json
-import difflib
+import hashlib
 
 import anthropic
 import dotenv
 
+from . import backend
 from . import detector
+from . import diff
+from . import fsutil
+from . import index
+from . import metrics
+from . import observations
+from . import scheduler
 from . import shell
+from . import sink
+from . import snapshot
+
+
+@dataclasses.dataclass
+class Limits:
+    """concurrency caps shared by every session in a process. shell
+    commands run on worker threads so their cap is a thread semaphore.
+    model_requests is None when a scheduler.Scheduler caps them instead"""
+    model_requests: asyncio.Semaphore|None
+    shell_commands: threading.BoundedSemaphore
+
+    @classmethod
+    def create(cls, model_requests: int|None = 8, shell_commands: int = 8) -> "Limits":
+        return cls(
+            asyncio.Semaphore(model_requests) if model_requests is not None else None,
+            threading.BoundedSemaphore(shell_commands),
+        )
+
+
+# where code blocks are streamed to until written, hidden so the index
+# and snapshots skip it, and inside the workspace so a write is a rename
+STAGING_DIR = ".staging"
+
+# the most lines search shows either side of a hit, so a few dozen hits
+# can't add up to whole files
+MAX_SEARCH_CONTEXT = 5
+
+# how often a command waiting for a shell slot checks whether its turn
+# has stopped
+SLOT_POLL_SECONDS = 0.1
+
+# how check_tests runs the workspace's tests
+TEST_COMMAND = "poetry run pytest"
+
+# appended to a reply that was cut off by a cancel or a deadline
+INTERRUPTED = "\n[interrupted]"
+
+# appended to a reply that was cut off by an error from the model
+FAILED = "\n[the model request failed]"
+
+
+async def until(deadline: float|None, chunks: typing.AsyncIterator[str]) -> typing.AsyncIterator[str]:
+    """pass chunks through, raising TimeoutError if the time.monotonic()
+    deadline passes while waiting for the next one"""
+    async with contextlib.aclosing(chunks):
+        if deadline is None:
+            async for chunk in chunks:
+                yield chunk
+            return
+        while True:
+            try:
+                chunk = await asyncio.wait_for(anext(chunks), deadline - time.monotonic())
+            except StopAsyncIteration:
+                return
+            except asyncio.TimeoutError:
+                raise TimeoutError("the turn's deadline passed") from None
+            yield chunk
 
 
 class ChatSession:
     transcript: list[dict]
-    client: anthropic.Anthropic
+    blobs: observations.BlobStore
+    backend: backend.Backend
     system: str
     base: str
+    limits: Limits
 
-    def __init__(self, client: anthropic.Anthropic, system: str, base: str):
+    def __init__(self, completions: backend.Backend, system: str, base: str,
+                 limits: Limits|None = None):
         self.transcript = []
+        self.blobs = observations.BlobStore()
         self.system = system
-        self.client = client
+        self.backend = completions
         self.base = base
+        self.limits = limits or Limits.create()
 
-    async def send_message_async(self, message: str) -> typing.AsyncGenerator[str, None]:
+    async def send_message_async(self, message: observations.Content) -> typing.AsyncGenerator[str, None]:
         """send a message to the model and yield the response
-        as it comes in"""
+        as it comes in. message is a string or a list of observation parts.
+        if cancelled, closed or failed part way, the reply so far is kept"""
         self.transcript.append({"role": "user", "content": message})
-        with self.client.messages.stream(
-            model="claude-3-opus-20240229",
-            max_tokens=4096,
-            messages=self.transcript,
-            system=self.system,
-        ) as stream:
-            completion = ""
-            for text in stream.text_stream:
-                completion += text
-                yield text
+        completion = ""
+        slots = self.limits.model_requests
+        try:
+            if slots is not None:
+                with metrics.span("model_queue_wait"):
+                    await slots.acquire()
+            try:
+                messages = observations.render(self.transcript, self.blobs)
+                chunks = 0
+                start = time.perf_counter()
+                with metrics.span("model_request"):
+                    # closing the stream aborts the request
+                    async with contextlib.aclosing(self.backend.stream(messages, self.system)) as stream:
+                        async for text in stream:
+                            if not chunks:
+                                metrics.observe("model_time_to_first_token_seconds", time.perf_counter() - start)
+                            chunks += 1
+                            completion += text
+                            yield text
+                metrics.observe("model_chunks_per_second", chunks / (time.perf_counter() - start))
+            finally:
+                if slots is not None:
+                    slots.release()
+        except (asyncio.CancelledError, GeneratorExit):
+            # the transcript must still alternate user and assistant
+            self.transcript.append({"role": "assistant", "content": completion + INTERRUPTED})
+            self.save()
+            raise
+        except Exception:
+            self.transcript.append({"role": "assistant", "content": completion + FAILED})
+            self.save()
+            raise
         self.transcript.append({"role": "assistant", "content": completion})
-        with open(os.path.join(self.base, "transcript.json"), "w") as file:
-            json.dump(self.transcript, file)
+        self.save()
+
+    def record_unanswered(self, message: observations.Content):
+        """add message to the transcript without sending it, as if its
+        reply was interrupted before it began, so later requests carry it"""
+        self.transcript.append({"role": "user", "content": message})
+        self.transcript.append({"role": "assistant", "content": INTERRUPTED})
+        self.save()
+
+    def save(self):
+        """persist the transcript alongside the workspace"""
+        with metrics.span("transcript_save"), open(os.path.join(self.base, "transcript.json"), "w") as file:
+            json.dump({
+                "blobs": self.blobs.referenced(self.transcript),
+                "messages": self.transcript,
+            }, file)
 
 
 class StatefulChat:
@@ -47,36 +159,84 @@ class StatefulChat:
     chat: ChatSession
     base_path: str
     sh: shell.Shell
+    limits: Limits
+    trace: metrics.Trace|None
+    index: index.WorkspaceIndex
+    snapshots: snapshot.SnapshotStore
+    turn: int
+    tool_timeout: float|None
+    turn_timeout: float|None
+    deadline: float|None
+    interrupted: threading.Event
+    tests: shell.ShellResponse|None
 
-    def __init__(self, system_prompt: str, base_path: str):
+    def __init__(self, system_prompt: str, base_path: str,
+                 completions: backend.Backend|None = None,
+                 sh: shell.Shell|None = None,
+                 limits: Limits|None = None,
+                 trace: str|None = None,
+                 tool_timeout: float|None = 300.0,
+                 turn_timeout: float|None = None):
         self.base_path = base_path
-        dotenv.load_dotenv()
-        client = anthropic.Anthropic(api_key=os.environ["ANTHROPIC_API_KEY"])
-        self.chat = ChatSession(client, system_prompt, self.base_path)
-        self.sh = shell.Shell(self.base_path, shell.python_isolation)
+        # seconds a shell command may run, and a whole turn may take
+        self.tool_timeout = tool_timeout
+        self.turn_timeout = turn_timeout
+        self.deadline = None
+        self.interrupted = threading.Event()
+        # the last check_tests result, until something changes the workspace
+        self.tests = None
+        # spans are only recorded while metrics are enabled
+        self.trace = metrics.Trace(trace) if trace else None
+        if completions is None:
+            dotenv.load_dotenv()
+            # the scheduler does the retrying, including mid stream
+            client = anthropic.AsyncAnthropic(api_key=os.environ["ANTHROPIC_API_KEY"], max_retries=0)
+            completions = scheduler.ScheduledBackend(
+                backend.AnthropicBackend(client), scheduler.Scheduler(), base_path,
+            )
+        self.limits = limits or Limits.create()
+        self.chat = ChatSession(completions, system_prompt, self.base_path, self.limits)
+        self.sh = sh or shell.Shell(self.base_path, shell.python_isolation)
+        self.index = index.WorkspaceIndex(self.base_path, ignore={"transcript.json"})
+        # turn 0 is the workspace as we found it. this is a new
+        # conversation so snapshots left by a previous one no longer apply
+        self.turn = 0
+        self.snapshots = snapshot.SnapshotStore(self.base_path, ignore={"transcript.json"})
+        self.snapshots.snapshot(self.turn, transcript_length=0)
+        self.snapshots.truncate(self.turn)
 
-    def write_file(self, path: str, content: str):
-        """write content to a file"""
+    def write_file(self, path: str, content: str|None = None, staged: str|None = None):
+        """write content to a file, or move staged, a file holding the
+        content, into its place"""
+        rel_path = path
         path = os.path.join(self.base_path, path)
-        basepath, _ = os.path.split(path)
-        if basepath and not os.path.exists(basepath):
-            os.makedirs(basepath)
+        if staged is not None:
+            digest = snapshot.hash_file(staged)
+        else:
+            digest = hashlib.sha256(content.encode()).hexdigest()
+        previous_digest = self.snapshots.digest(rel_path)
+        if previous_digest == digest:
+            return f"{path} already has this content, nothing to write"
         previous = None
-        if os.path.exists(path):
-            previous = self.cat_file(path)
-        with open(path, "w") as file:
-            file.write(content)
-        if previous is None:
-            return f"created {path}"
+        if previous_digest is not None:
+            previous = self.cat_file(rel_path)
+        self.tests = None
+        # readers in the container must never see a half written file
+        if staged is not None:
+            fsutil.replace_with(staged, path)
+            content = self.cat_file(rel_path)
         else:
-            diff = difflib.unified_diff(
-                previous.split("\n"),
-                content.split("\n"),
-                fromfile="before",
-                tofile="after"
-            )
-            return f"updated {path}\nunified diff\n" + "\n".join(diff)
-        
+            fsutil.atomic_write(path, content)
+        self.index.update(rel_path, content)
+        # the model already has this content in its own code block, so
+        # we only note that any copy it saw before is now outdated
+        written = self.chat.blobs.changed(rel_path, digest)
+        if previous is None:
+            return [observations.text(f"created {path}"), written]
+        return [
+            observations.text(f"updated {path}\nunified diff\n" + diff.unified_diff(previous, content)),
+            written,
+        ]
 
     def cat_file(self, path):
         """read a file's content"""
@@ -84,17 +244,22 @@ class StatefulChat:
         with open(path) as file:
             return file.read()
 
-    def cat_files_of_type(self, suffix):
+    def observe_file(self, path: str) -> list[observations.Part]:
+        """a file's content as an observation"""
+        return [self.chat.blobs.file(path, self.cat_file(path))]
+
+    def cat_files_of_type(self, suffix) -> list[observations.Part]:
         """read all files with a given suffix"""
-        result = ""
-        for root, _, files in os.walk(self.base_path):
+        result = []
+        for root, dirs, files in os.walk(self.base_path):
+            # ignore hidden directories, including the snapshot store
+            dirs[:] = [d for d in dirs if not d.startswith(".")]
             for file in files:
                 if file.endswith(suffix):
                     rel_path = os.path.relpath(os.path.join(root, file), self.base_path)
-                    result += f"#### {rel_path}\n"
-                    result += "```\n"
-                    result += self.cat_file(rel_path)
-                    result += "\n```\n\n"
+                    result.append(observations.text(f"#### {rel_path}\n```\n"))
+                    result.extend(self.observe_file(rel_path))
+                    result.append(observations.text("\n```\n\n"))
         return result
 
     def file_metadata(self, path: str) -> str:
@@ -120,24 +285,94 @@ class StatefulChat:
             result += "\n"
         return result
 
+    def search(self, pattern: str, kind: str = "text", context: int = 1) -> str:
+        """search the workspace for lines matching pattern and report
+        them as path:line with up to MAX_SEARCH_CONTEXT lines of
+        context"""
+        # pick up anything changed behind our back (e.g. by the shell)
+        self.index.refresh()
+        # json numbers arrive from the model's commands as floats
+        context = min(max(int(context), 0), MAX_SEARCH_CONTEXT)
+        hits = self.index.search(pattern, kind=kind, context=context)
+        if not hits:
+            return f"no matches for {pattern}"
+        return "\n".join(str(hit) for hit in hits)
+
+    def run_shell(self, line: str) -> shell.ShellResponse:
+        """run a command in the session's shell, waiting for a slot if
+        too many commands are running across all sessions. if the turn
+        stops while it waits the command never runs, as it could
+        otherwise start once the next turn is using the shell"""
+        if not self._shell_slot():
+            return shell.ShellResponse(f"[not run, {self.stopped()}]", 130)
+        try:
+            return self.sh.run(line, timeout=self.shell_timeout())
+        finally:
+            self.limits.shell_commands.release()
+
+    def _shell_slot(self) -> bool:
+        """acquire a shell slot, false if the turn stopped first"""
+        with metrics.span("shell_queue_wait"):
+            while not self.limits.shell_commands.acquire(timeout=SLOT_POLL_SECONDS):
+                if self.stopped() is not None:
+                    return False
+        if self.stopped() is not None:
+            self.limits.shell_commands.release()
+            return False
+        return True
+
+    def shell_timeout(self) -> float|None:
+        """how long the next shell command may run: the tool timeout or
+        what is left of the turn, whichever is shorter"""
+        limits = [self.tool_timeout]
+        if self.deadline is not None:
+            limits.append(max(0.0, self.deadline - time.monotonic()))
+        limits = [limit for limit in limits if limit is not None]
+        return min(limits) if limits else None
+
+    def stopped(self) -> str|None:
+        """why the current turn should run no more tools, if it should stop"""
+        if self.interrupted.is_set():
+            return "the turn was interrupted"
+        if self.deadline is not None and time.monotonic() >= self.deadline:
+            return f"the turn ran out of time after {self.turn_timeout} seconds"
+        return None
+
+    def stop_notice(self) -> str:
+        """what to tell the user when the turn ends early"""
+        if self.interrupted.is_set():
+            return INTERRUPTED + "\n"
+        return f"\n[stopped, the turn took longer than {self.turn_timeout} seconds]\n"
+
+    def interrupt(self):
+        """skip the turn's remaining tools and interrupt the running shell
+        command. safe to call while evaluate_tools runs on another thread"""
+        self.interrupted.set()
+        self.sh.interrupt()
+
     def run_tests(self) -> str:
         """run tests in the tests/ directory"""
 
-        result = self.sh.run("poetry run pytest")
+        result = self.tests = self.run_shell(TEST_COMMAND)
         if result.return_code == 0:
             return "all tests passed"
         return f"pytests failed with {result.return_code}: {result.output}"
 
     def run_poetry(self, args: list[str]) -> str:
         """run a poetry command"""
-        result = self.sh.run(f"poetry {' '.join(args)}")
+        self.tests = None
+        result = self.run_shell(f"poetry {' '.join(args)}")
         if result.return_code == 0:
             return result.output
         return f"poetry failed with {result.return_code}: {result.output}"
 
-    def evaluate_tools(self, message: str) -> str|None:
+    def evaluate_tools(self, message: str) -> list[observations.Part]:
         """evaluate any tools in the message and return the result"""
-        parser = detector.JSONMDParser()
+        return self.evaluate_elements(detector.JSONMDParser().scan(message))
+
+    def evaluate_elements(self, elements: typing.Iterable[typing.Any]) -> list[observations.Part]:
+        """evaluate the tools among the elements of a parsed message, in
+        which code blocks are CodeBlocks or sink.StagedBlocks"""
         # pathish = re.compile(r"([\w/]+\.\w+)")
         
         active_code_block = None
@@ -145,30 +380,35 @@ class StatefulChat:
         def inner_write_file(**args):
             if active_code_block is None:
                 raise ValueError("there was no code block immediately before this write_file command. a code block must appear before the write_file command")
+            if isinstance(active_code_block, sink.StagedBlock):
+                return self.write_file(**args, staged=active_code_block.path)
             return self.write_file(**args, content=active_code_block.code)
         
         tools = {
             "write_file": lambda **args: inner_write_file(**args),
-            "cat_file": lambda **args: self.cat_file(**args),
+            "cat_file": lambda **args: self.observe_file(**args),
             "cat_files_of_type": lambda **args: self.cat_files_of_type(**args),
             "ls_tree": lambda **args: self.ls_tree(**args),
+            "search": lambda **args: self.search(**args),
             "check_tests": lambda **args: self.run_tests(**args),
             "poetry": lambda **args: self.run_poetry(**args),
         }
 
-        observations = []
-        for element in parser.scan(message):
-            if isinstance(element, detector.CodeBlock):
+        observed = []
+        for element in elements:
+            if isinstance(element, (detector.CodeBlock, sink.StagedBlock)):
                 if element.language == 'json':
                     # gemini can't be trusted to not put commands in
                     # code blocks blocks, so we'll parse them here
                     try:
                         element = json.loads(element.code)
                     except json.JSONDecodeError as exc:
-                        observations.append(f"{element.code}: failed to parse as json: {exc}")
+                        observed.append(f"{element.code}: failed to parse as json: {exc}")
                         continue
                 else:
-                    if active_code_block is not None:
+                    if isinstance(active_code_block, sink.StagedBlock):
+                        active_code_block.append(element)
+                    elif active_code_block is not None:
                         active_code_block.code += element.code
                     else:
                         # gemini also insists on skipping write_file and
@@ -185,43 +425,121 @@ class StatefulChat:
                 continue
 
             if "command" not in element:
-                observations.append(json.dumps(element) + " is bare json without a command key")
+                observed.append(json.dumps(element) + " is bare json without a command key")
                 continue
 
             name = element["command"]
             element.pop("command")
             if name not in tools:
-                observations.append(f"unknown tool {name}")
+                observed.append(f"unknown tool {name}")
+                continue
+            reason = self.stopped()
+            if reason is not None:
+                observed.append(f"skipped {name}, {reason}")
                 continue
 
             try:
-                result = tools[name](**element)
-                if result is not None:
-                    observations.append(f"invoked {name} with {element} and got {result}")
+                with metrics.span("tool_call", tool=name):
+                    result = tools[name](**element)
+                if isinstance(result, list):
+                    observed.append([observations.text(f"invoked {name} with {element} and got "), *result])
+                elif result is not None:
+                    observed.append(f"invoked {name} with {element} and got {result}")
                 active_code_block = None
             except Exception as exc:
-                observations.append(f"failed to invoke {name} with {element}: {exc}")
+                observed.append(f"failed to invoke {name} with {element}: {exc}")
         
         # if active_code_block is not None:
-        #     observations.append("the final code block was not folloed by a write_file command")
+        #     observed.append("the final code block was not folloed by a write_file command")
 
-        return "\n".join(f"OBSERVATION: {obs}\n" for obs in observations)
+        parts = []
+        for n, obs in enumerate(observed):
+            if isinstance(obs, str):
+                obs = [observations.text(obs)]
+            separator = "\n" if n else ""
+            parts += [observations.text(f"{separator}OBSERVATION: "), *obs, observations.text("\n")]
+        return observations.merge(parts)
 
-    async def interact(self, prompt: str) -> typing.Generator[str,str,None]:
+    async def interact(self, prompt: str) -> typing.AsyncGenerator[str, None]:
         """send the next interaction to the model and yield the response.
-        automatically invoke any tools and reprompt as necessary"""
+        automatically invoke any tools and reprompt as necessary.
+
+        cancelling the task iterating this, or closing it, aborts the model
+        stream, interrupts the running shell command and drops any pending
+        followups. past turn_timeout, or once interrupt() is called, the
+        turn ends early, keeping the output of the tools that ran. either
+        way the session can carry on with the next turn"""
+        metrics.use_trace(self.trace)
+        start = time.perf_counter()
+        self.interrupted.clear()
+        self.deadline = None if self.turn_timeout is None else time.monotonic() + self.turn_timeout
         followups = [lambda: self.chat.send_message_async(prompt)]
         
-        while followups:
-            responses = followups.pop(0)()
-            full_completion = ""
-            async for text in responses:
-                full_completion += text
-                yield text
-            yield "\n"
-            tool_output = self.evaluate_tools(full_completion)
-            if tool_output:
-                followups.append(lambda: self.chat.send_message_async(tool_output))
+        try:
+            while followups:
+                responses = until(self.deadline, followups.pop(0)())
+                # code blocks go straight to disk as they stream
+                blocks = sink.BlockSink(os.path.join(self.base_path, STAGING_DIR))
+                elements = []
+                try:
+                    async with contextlib.aclosing(responses):
+                        async for text in responses:
+                            elements += blocks.feed(text)
+                            yield text
+                    elements += blocks.close()
+                    yield "\n"
+                    tool_output = await self.evaluate_tools_async(elements)
+                finally:
+                    blocks.discard()
+                if tool_output and self.stopped() is not None:
+                    # what the tools that did run saw is still worth keeping
+                    self.chat.record_unanswered(tool_output)
+                    yield self.stop_notice()
+                    break
+                if tool_output:
+                    followups.append(lambda: self.chat.send_message_async(tool_output))
+        except TimeoutError:
+            yield self.stop_notice()
+
+        self.turn += 1
+        await asyncio.to_thread(
+            self.snapshots.snapshot, self.turn, transcript_length=len(self.chat.transcript),
+        )
+        metrics.observe("turn_seconds", time.perf_counter() - start)
+
+    async def evaluate_tools_async(self, elements: list[typing.Any]) -> list[observations.Part]:
+        """evaluate_elements on a worker thread. tools block on the filesystem
+        and the shell, this keeps them off the event loop so other sessions
+        can make progress"""
+        return await self.interruptible(self.evaluate_elements, elements)
+
+    async def interruptible(self, function: typing.Callable[..., typing.Any], *args) -> typing.Any:
+        """function(*args), which uses the shell, on a worker thread. if
+        cancelled, the running command is interrupted and we wait for the
+        shell to return to its prompt"""
+        work = asyncio.ensure_future(asyncio.to_thread(function, *args))
+        try:
+            return await asyncio.shield(work)
+        except asyncio.CancelledError:
+            self.interrupt()
+            await asyncio.wait({work}, timeout=shell.INTERRUPT_GRACE)
+            raise
+
+    def rewind(self, turn: int) -> list[str]:
+        """restore the workspace and transcript to how they were at the
+        end of turn. returns the paths that changed"""
+        target = self.snapshots.load(turn)
+        changed = self.snapshots.rollback(turn)
+        del self.chat.transcript[target.meta["transcript_length"]:]
+        self.chat.save()
+        self.turn = turn
+        return changed
+
+    def close(self):
+        """release the session's shell and trace"""
+        self.sh.close()
+        if self.trace is not None:
+            self.trace.close()
 
 
 async def main():
@@ -0,0 +1,211 @@
+"""timing spans and histograms for the agent loop
+
+metrics are off by default and span() then returns a shared object whose
+enter and exit do nothing, so instrumented code pays one attribute check.
+once enabled, every span is observed into a histogram named after it,
+which can be dumped as prometheus text or json. when a trace is active
+(see use_trace) each span is also appended to that trace as a json line"""
+
+import bisect
+import contextvars
+import json
+import threading
+import time
+import typing
+
+
+TIME_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0)
+SIZE_BUCKETS = (100, 1000, 10_000, 100_000, 1_000_000, 10_000_000)
+RATE_BUCKETS = (1, 5, 10, 25, 50, 100, 250, 500, 1000)
+
+
+def buckets_for(name: str) -> tuple[float, ...]:
+    """histogram buckets chosen by the unit at the end of the name"""
+    if name.endswith("_bytes"):
+        return SIZE_BUCKETS
+    if name.endswith("_per_second"):
+        return RATE_BUCKETS
+    return TIME_BUCKETS
+
+
+class Histogram:
+    """cumulative bucket counts plus sum and count, as prometheus expects"""
+    buckets: tuple[float, ...]
+    counts: list[int]
+    sum: float
+    count: int
+
+    def __init__(self, buckets: tuple[float, ...]):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        index = bisect.bisect_left(self.buckets, value)
+        if index < len(self.counts):
+            self.counts[index] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self) -> list[int]:
+        result = []
+        total = 0
+        for count in self.counts:
+            total += count
+            result.append(total)
+        return result
+
+
+class Trace:
+    """a per-session json lines file of every span"""
+    file: typing.TextIO
+    lock: threading.Lock
+
+    def __init__(self, path: str):
+        self.file = open(path, "a")
+        self.lock = threading.Lock()
+
+    def write(self, record: dict):
+        with self.lock:
+            self.file.write(json.dumps(record) + "\n")
+            self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+# the trace spans should be written to, see use_trace
+current_trace: contextvars.ContextVar[Trace|None] = contextvars.ContextVar("current_trace", default=None)
+
+
+class Span:
+    """times a block and observes the duration when it exits"""
+    registry: "Registry"
+    name: str
+    labels: dict[str, str]
+    start: float
+
+    def __init__(self, registry: "Registry", name: str, labels: dict[str, str]):
+        self.registry = registry
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self) -> "Span":
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        duration = time.perf_counter() - self.start
+        self.registry.observe(f"{self.name}_seconds", duration, trace=False, **self.labels)
+        trace = current_trace.get()
+        if trace is not None:
+            trace.write({"span": self.name, "start": self.start, "seconds": duration, **self.labels})
+        return False
+
+
+class NullSpan:
+    """what span() returns while metrics are disabled"""
+
+    def __enter__(self) -> "NullSpan":
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+NULL_SPAN = NullSpan()
+
+
+class Registry:
+    """the histograms observed so far, keyed by name and labels"""
+    enabled: bool
+    histograms: dict[tuple[str, tuple[tuple[str, str], ...]], Histogram]
+    lock: threading.Lock
+
+    def __init__(self, enabled: bool = False):
+        self.enabled = enabled
+        self.histograms = {}
+        self.lock = threading.Lock()
+
+    def span(self, name: str, **labels: str) -> Span|NullSpan:
+        """time a block as histogram {name}_seconds"""
+        if not self.enabled:
+            return NULL_SPAN
+        return Span(self, name, labels)
+
+    def observe(self, name: str, value: float, trace: bool = True, **labels: str):
+        """record a value in histogram name, and in the current trace
+        unless trace is false"""
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram(buckets_for(name))
+            histogram.observe(value)
+        current = current_trace.get() if trace else None
+        if current is not None:
+            current.write({"metric": name, "value": value, **labels})
+
+    def prometheus(self) -> str:
+        """the histograms in the prometheus text exposition format"""
+        lines = []
+        typed = set()
+        with self.lock:
+            for (name, labels), histogram in sorted(self.histograms.items()):
+                metric = f"agent_{name}"
+                if metric not in typed:
+                    lines.append(f"# TYPE {metric} histogram")
+                    typed.add(metric)
+                label_text = ",".join(f'{key}="{value}"' for key, value in labels)
+                prefix = label_text + "," if label_text else ""
+                for bound, count in zip(histogram.buckets, histogram.cumulative()):
+                    lines.append(f'{metric}_bucket{{{prefix}le="{bound}"}} {count}')
+                lines.append(f'{metric}_bucket{{{prefix}le="+Inf"}} {histogram.count}')
+                suffix = f"{{{label_text}}}" if label_text else ""
+                lines.append(f"{metric}_sum{suffix} {histogram.sum}")
+                lines.append(f"{metric}_count{suffix} {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+    def to_json(self) -> list[dict]:
+        """the histograms as a list of plain dicts"""
+        with self.lock:
+            return [
+                {
+                    "name": name,
+                    "labels": dict(labels),
+                    "count": histogram.count,
+                    "sum": histogram.sum,
+                    "buckets": dict(zip(histogram.buckets, histogram.cumulative())),
+                }
+                for (name, labels), histogram in sorted(self.histograms.items())
+            ]
+
+    def reset(self):
+        with self.lock:
+            self.histograms.clear()
+
+
+# the process wide registry used by the instrumented code
+REGISTRY = Registry()
+
+
+def span(name: str, **labels: str) -> Span|NullSpan:
+    return REGISTRY.span(name, **labels)
+
+
+def observe(name: str, value: float, **labels: str):
+    REGISTRY.observe(name, value, **labels)
+
+
+def enable(enabled: bool = True):
+    REGISTRY.enabled = enabled
+
+
+def use_trace(trace: Trace|None):
+    """send spans from the current task, and from worker threads it
+    starts with asyncio.to_thread, to trace. every asyncio task has its
+    own copy of the context so concurrent sessions don't interfere"""
+    current_trace.set(trace)
@@ -0,0 +1,108 @@
+"""transcript storage that keeps file content observed by tools as
+references to content addressed blobs
+
+a message's content is either a plain string or a list of parts. a part
+is a dict that is either {"type": "text", "text": ...} or
+{"type": "file", "path": ..., "blob": ..., "shown": bool}. file parts are
+resolved when the transcript is rendered for a request: only the latest
+copy of each path is sent in full and earlier copies become short notes
+pointing forward to it. a file part with shown false records that the
+path changed (e.g. the model wrote it) by the digest of its content
+alone, the content itself is neither stored nor repeated"""
+
+import hashlib
+import os
+import typing
+
+
+Part = dict
+Content = str|list[Part]
+
+
+class BlobStore:
+    """text interned by its sha256 so repeated content is held once"""
+    blobs: dict[str, str]
+
+    def __init__(self, blobs: dict[str, str]|None = None):
+        self.blobs = blobs or {}
+
+    def put(self, text: str) -> str:
+        """store text and return its address"""
+        blob = hashlib.sha256(text.encode()).hexdigest()
+        self.blobs.setdefault(blob, text)
+        return blob
+
+    def get(self, blob: str) -> str:
+        return self.blobs[blob]
+
+    def file(self, path: str, text: str) -> Part:
+        """a part recording that path had content text"""
+        return {"type": "file", "path": os.path.normpath(path), "blob": self.put(text), "shown": True}
+
+    def changed(self, path: str, blob: str) -> Part:
+        """a part recording that path now has the content with address
+        blob. the content isn't stored, the part is never shown and only
+        outdates earlier copies"""
+        return {"type": "file", "path": os.path.normpath(path), "blob": blob, "shown": False}
+
+    def referenced(self, messages: list[dict]) -> dict[str, str]:
+        """the blobs still referenced by messages"""
+        return {
+            part["blob"]: self.blobs[part["blob"]]
+            for part in _file_parts(messages)
+            if part["shown"]
+        }
+
+
+def text(value: str) -> Part:
+    """a plain text part"""
+    return {"type": "text", "text": value}
+
+
+def merge(parts: list[Part]) -> list[Part]:
+    """coalesce adjacent text parts"""
+    merged = []
+    for part in parts:
+        if part["type"] == "text" and merged and merged[-1]["type"] == "text":
+            merged[-1] = text(merged[-1]["text"] + part["text"])
+        else:
+            merged.append(part)
+    return merged
+
+
+def _file_parts(messages: list[dict]) -> typing.Iterator[Part]:
+    for message in messages:
+        if isinstance(message["content"], str):
+            continue
+        for part in message["content"]:
+            if part["type"] == "file":
+                yield part
+
+
+def render(messages: list[dict], blobs: BlobStore) -> list[dict]:
+    """the messages as plain strings ready to send to the model, with
+    every file copy but the latest for its path replaced by a note"""
+    latest = {}
+    for part in _file_parts(messages):
+        latest[part["path"]] = part
+
+    rendered = []
+    for message in messages:
+        content = message["content"]
+        if not isinstance(content, str):
+            content = "".join(_render_part(part, latest, blobs) for part in content)
+        rendered.append({"role": message["role"], "content": content})
+    return rendered
+
+
+def _render_part(part: Part, latest: dict[str, Part], blobs: BlobStore) -> str:
+    if part["type"] == "text":
+        return part["text"]
+    newest = latest[part["path"]]
+    if newest is part:
+        return blobs.get(part["blob"]) if part["shown"] else ""
+    if not part["shown"]:
+        return ""
+    if newest["blob"] == part["blob"]:
+        return f"[content of {part['path']} omitted, it is identical to a later copy in this conversation]"
+    return f"[content of {part['path']} omitted, it is outdated by a later version in this conversation]"
@@ -0,0 +1,273 @@
+"""a model request scheduler shared by every session in a process
+
+the scheduler admits requests while they fit the configured requests per
+minute and tokens per minute budgets and the concurrency cap. waiting
+sessions are served round robin so one busy session can't starve the
+rest. ScheduledBackend runs each request through the scheduler, retries
+rate limit, overload and connection failures with jittered exponential
+backoff, and resumes a stream that failed part way through by asking the
+model to continue from what it had already produced"""
+
+import asyncio
+import collections
+import contextlib
+import dataclasses
+import os
+import random
+import time
+import typing
+
+import anthropic
+
+try:
+    import httpx
+except ImportError:  # newer anthropic clients are built on httpx2
+    import httpx2 as httpx
+
+from . import backend
+from . import metrics
+
+
+# statuses worth retrying: timeouts, rate limits, server errors, overload
+TRANSIENT_STATUSES = {408, 429, 500, 502, 503, 504, 529}
+
+# the same failures as the api names them in an error body
+TRANSIENT_ERRORS = {"rate_limit_error", "api_error", "timeout_error", "overloaded_error"}
+
+
+def error_type(exc: Exception) -> str|None:
+    """the type in exc's error body, e.g. "overloaded_error", if any"""
+    body = getattr(exc, "body", None)
+    error = body.get("error") if isinstance(body, dict) else None
+    return error.get("type") if isinstance(error, dict) else None
+
+
+def is_transient(exc: Exception) -> bool:
+    """true if exc is a failure that may succeed when retried. an error
+    event part way through a stream carries the stream's status, 200, so
+    its body says what went wrong. a connection that breaks part way
+    through raises httpx's own errors, the client doesn't wrap those"""
+    if isinstance(exc, (anthropic.APIConnectionError, httpx.TransportError)):
+        return True
+    return getattr(exc, "status_code", None) in TRANSIENT_STATUSES or error_type(exc) in TRANSIENT_ERRORS
+
+
+def retry_after(exc: Exception) -> float|None:
+    """the delay the server asked for, if any"""
+    response = getattr(exc, "response", None)
+    headers = getattr(response, "headers", None) or {}
+    try:
+        return float(headers.get("retry-after"))
+    except (TypeError, ValueError):
+        return None
+
+
+def estimate_tokens(messages: list[dict], system: str) -> int:
+    """a rough input token count, about four characters a token"""
+    return (len(system) + sum(len(message["content"]) for message in messages)) // 4 + 1
+
+
+class Budget:
+    """a token bucket holding up to per_minute units that refills
+    continuously. None means unlimited"""
+    per_minute: float|None
+    available: float
+    updated: float
+
+    def __init__(self, per_minute: float|None, clock: typing.Callable[[], float]):
+        self.per_minute = per_minute
+        self.available = per_minute or 0.0
+        self.clock = clock
+        self.updated = clock()
+
+    def _refill(self):
+        now = self.clock()
+        self.available = min(self.per_minute, self.available + (now - self.updated) * self.per_minute / 60)
+        self.updated = now
+
+    def wait(self, amount: float) -> float:
+        """seconds until amount is available, 0 if it is now. a request
+        larger than the whole budget only waits for a full bucket"""
+        if self.per_minute is None:
+            return 0.0
+        self._refill()
+        amount = min(amount, self.per_minute)
+        if self.available >= amount:
+            return 0.0
+        return (amount - self.available) * 60 / self.per_minute
+
+    def take(self, amount: float):
+        if self.per_minute is not None:
+            self._refill()
+            self.available -= min(amount, self.per_minute)
+
+
+@dataclasses.dataclass
+class Waiter:
+    tokens: int
+    future: asyncio.Future
+
+
+class Scheduler:
+    """admits model requests from many sessions within shared budgets"""
+    requests: Budget
+    tokens: Budget
+    max_concurrent: int
+    max_retries: int
+    base_delay: float
+    max_delay: float
+    in_flight: int
+    paused_until: float
+    queues: dict[str, collections.deque[Waiter]]
+    ring: collections.deque[str]
+
+    def __init__(self, requests_per_minute: float|None = None,
+                 tokens_per_minute: float|None = None,
+                 max_concurrent: int = 8, max_retries: int = 5,
+                 base_delay: float = 1.0, max_delay: float = 60.0,
+                 clock: typing.Callable[[], float] = time.monotonic,
+                 rng: random.Random|None = None):
+        self.clock = clock
+        self.requests = Budget(requests_per_minute, clock)
+        self.tokens = Budget(tokens_per_minute, clock)
+        self.max_concurrent = max_concurrent
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.rng = rng or random.Random()
+        self.in_flight = 0
+        self.paused_until = 0.0
+        self.queues = {}
+        self.ring = collections.deque()
+        self.timer = None
+
+    @contextlib.asynccontextmanager
+    async def slot(self, session: str, tokens: int) -> typing.AsyncIterator[None]:
+        """wait for this session's turn to send a request of about tokens
+        input tokens, and hold a concurrency slot for the block"""
+        future = asyncio.get_running_loop().create_future()
+        if session not in self.queues:
+            self.queues[session] = collections.deque()
+            self.ring.append(session)
+        self.queues[session].append(Waiter(tokens, future))
+        self._dispatch()
+        try:
+            with metrics.span("scheduler_wait"):
+                await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # we were admitted just as we were cancelled
+                self._release()
+            else:
+                self._forget(session, future)
+            raise
+        try:
+            yield
+        finally:
+            self._release()
+
+    def backoff(self, attempt: int, exc: Exception) -> float:
+        """how long to wait before retry number attempt (from 0). rate
+        limits also pause every other session for the delay the server
+        asked for, so a burst doesn't hit the limit again in lockstep"""
+        delay = self.rng.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+        requested = retry_after(exc)
+        if requested is not None:
+            delay = max(delay, requested)
+        if getattr(exc, "status_code", None) == 429 or error_type(exc) == "rate_limit_error":
+            self.paused_until = max(self.paused_until, self.clock() + (requested or delay))
+        return delay
+
+    def _forget(self, session: str, future: asyncio.Future):
+        queue = self.queues.get(session)
+        if queue is None:
+            return
+        for waiter in queue:
+            if waiter.future is future:
+                queue.remove(waiter)
+                break
+        if not queue:
+            del self.queues[session]
+            self.ring.remove(session)
+        self._dispatch()
+
+    def _release(self):
+        self.in_flight -= 1
+        self._dispatch()
+
+    def _dispatch(self):
+        """admit waiters, round robin across sessions, while capacity lasts"""
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        while self.ring and self.in_flight < self.max_concurrent:
+            session = self.ring[0]
+            waiter = self.queues[session][0]
+            wait = max(
+                self.paused_until - self.clock(),
+                self.requests.wait(1),
+                self.tokens.wait(waiter.tokens),
+            )
+            if wait > 0:
+                self.timer = asyncio.get_running_loop().call_later(wait, self._dispatch)
+                return
+            self.queues[session].popleft()
+            self.ring.rotate(-1)
+            if not self.queues[session]:
+                del self.queues[session]
+                self.ring.remove(session)
+            self.requests.take(1)
+            self.tokens.take(waiter.tokens)
+            self.in_flight += 1
+            waiter.future.set_result(None)
+
+
+class ScheduledBackend:
+    """runs another backend's requests through a shared scheduler on
+    behalf of one session, retrying transient failures. waited adds up
+    the seconds spent queued for the scheduler or backing off, so a
+    backend.RecordingBackend wrapping this one can leave them out"""
+    backend: backend.Backend
+    scheduler: Scheduler
+    session: str
+    waited: float
+
+    def __init__(self, completions: backend.Backend, scheduler: Scheduler, session: str):
+        self.backend = completions
+        self.scheduler = scheduler
+        self.session = session
+        self.waited = 0.0
+
+    async def stream(self, messages: list[dict], system: str) -> typing.AsyncIterator[str]:
+        emitted = ""
+        attempt = 0
+        while True:
+            request = messages
+            # whitespace the model already sent but the api won't accept at
+            # the end of a prefill. don't send it twice when we continue
+            pending = ""
+            if emitted:
+                prefill = emitted.rstrip()
+                pending = emitted[len(prefill):]
+                if prefill:
+                    request = messages + [{"role": "assistant", "content": prefill}]
+            queued = time.perf_counter()
+            try:
+                async with self.scheduler.slot(self.session, estimate_tokens(request, system)):
+                    self.waited += time.perf_counter() - queued
+                    async for text in self.backend.stream(request, system):
+                        if pending:
+                            text = text[len(os.path.commonprefix([text, pending])):]
+                            pending = ""
+                        emitted += text
+                        yield text
+                return
+            except Exception as exc:
+                if not is_transient(exc) or attempt >= self.scheduler.max_retries:
+                    raise
+                delay = self.scheduler.backoff(attempt, exc)
+                metrics.observe("model_retry_delay_seconds", delay,
+                                status=str(getattr(exc, "status_code", "connection")))
+            attempt += 1
+            await asyncio.sleep(delay)
+            self.waited += delay
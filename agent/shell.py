@@ -2,9 +2,13 @@
 import dataclasses
 import re
 import os
+import threading
+import uuid
 
 import pexpect
 
+from . import metrics
+
 @dataclasses.dataclass
 class ShellEnvironment:
     """a shell environment"""
@@ -22,6 +26,21 @@ IMAGE="python_isolation"#"python:3.11.9-slim-bullseye"
 SENTINAL="MySentinalPrompt>"
 DOCKER="/usr/local/bin/docker"
 
+# seconds an interrupted command gets to return to the prompt
+INTERRUPT_GRACE = 10
+
+ANSI_ESCAPE = re.compile(r'''
+    \x1B  # ESC
+    (?:   # 7-bit C1 Fe (except CSI)
+        [@-Z\\-_]
+    |     # or [ for CSI, followed by a control sequence
+        \[
+        [0-?]*  # Parameter bytes
+        [ -/]*  # Intermediate bytes
+        [@-~]   # Final byte
+    )
+''', re.VERBOSE)
+
 @dataclasses.dataclass
 class ShellResponse:
     """a response from a shell command"""
@@ -33,9 +52,16 @@ class Shell:
     """a shell session"""
     shell: pexpect.spawn
     env: ShellEnvironment
+    lock: threading.Lock
+    running: bool
+    interrupted: bool
 
     def __init__(self, cwd: str, env: ShellEnvironment):
         self.env = env
+        # guards running, which interrupt checks from other threads
+        self.lock = threading.Lock()
+        self.running = False
+        self.interrupted = False
         cwd = os.path.abspath(cwd)
         self.shell = pexpect.spawn(f"{DOCKER} run -v {cwd}:/app -it {env.image} /bin/bash -l")
         result = self.shell.expect([":/#", pexpect.EOF, pexpect.TIMEOUT], timeout=120)
@@ -53,32 +79,63 @@ class Shell:
         #self.run("poetry shell")
         self.run("poetry install")
 
-    def _run_echo(self, line: str, timeout) -> str:
-        ansi_escape = re.compile(r'''
-            \x1B  # ESC
-            (?:   # 7-bit C1 Fe (except CSI)
-                [@-Z\\-_]
-            |     # or [ for CSI, followed by a control sequence
-                \[
-                [0-?]*  # Parameter bytes
-                [ -/]*  # Intermediate bytes
-                [@-~]   # Final byte
-            )
-        ''', re.VERBOSE)
-        self.shell.sendline(line)
-        self.shell.expect(SENTINAL, timeout=timeout)
+    def _send(self, line: str):
+        with self.lock:
+            self.shell.sendline(line)
+            self.running = True
 
-        unescaped = ansi_escape.sub('', self.shell.before.decode())
+    def _output(self, timeout) -> str:
+        """wait for the prompt and return what the command printed"""
+        self.shell.expect(SENTINAL, timeout=timeout)
+        with self.lock:
+            self.running = False
+        unescaped = ANSI_ESCAPE.sub('', self.shell.before.decode())
 
         output = unescaped.split('\r\n')[1:]
         
         return ("\n".join(output)).replace('\r', '')
 
+    def _run_echo(self, line: str, timeout) -> str:
+        self._send(line)
+        return self._output(timeout)
+
+    def _resync(self) -> int:
+        """after an interrupt the shell may print an extra prompt, so read
+        up to a fresh marker to line up the next command's output. returns
+        the interrupted command's exit code"""
+        marker = uuid.uuid4().hex
+        # quote inside the marker so the echoed command line can't match
+        self.shell.sendline(f"echo $?:{marker[:16]}''{marker[16:]}")
+        self.shell.expect(rf"(\d+):{marker}")
+        code = int(self.shell.match.group(1))
+        self.shell.expect(SENTINAL)
+        return code
+
     def run(self, line: str, timeout=-1) -> ShellResponse:
-        """send a line to the shell"""
-        output = self._run_echo(line, timeout)
-        code = self._run_echo("echo $?", -1)
-        return ShellResponse(output, int(code))
+        """send a line to the shell. a command still running after timeout
+        seconds is interrupted and what it printed so far is returned"""
+        with metrics.span("shell_run"):
+            self.interrupted = False
+            try:
+                output = self._run_echo(line, timeout)
+            except pexpect.TIMEOUT:
+                self.interrupt()
+                output = self._output(INTERRUPT_GRACE) + f"\n[interrupted after {timeout} seconds]"
+            if self.interrupted:
+                code = self._resync()
+            else:
+                self.shell.sendline("echo $?")
+                code = int(self._output(-1))
+        metrics.observe("shell_output_bytes", len(output))
+        return ShellResponse(output, code)
+
+    def interrupt(self):
+        """send ctrl-c to the command being run, if there is one. safe to
+        call from another thread while run waits for the command"""
+        with self.lock:
+            if self.running:
+                self.shell.sendintr()
+                self.interrupted = True
 
     def close(self):
         self.shell.terminate(force=True)
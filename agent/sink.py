@@ -0,0 +1,156 @@
+"""stream fenced code blocks from the model's reply to disk as they arrive
+
+BlockSink is an incremental detector.JSONMDParser.scan. it is fed the
+reply a chunk at a time and appends the body of each fenced block to a
+staging file as it streams, so a generated file is never held whole in
+memory. it returns the elements scan would, with a StagedBlock in place
+of each CodeBlock. whoever handles the write_file command that follows a
+block moves its staging file into place (see fsutil.replace_with), and
+discard() deletes any staging file nobody claimed"""
+
+import dataclasses
+import os
+import tempfile
+import typing
+
+from . import detector
+
+
+FENCE = "```"
+
+
+@dataclasses.dataclass
+class StagedBlock:
+    """a code block whose body was streamed to path. heading is the last
+    line of text before the block, e.g. "#### src/main.py" """
+    language: str|None
+    path: str
+    heading: str
+    size: int = 0
+
+    def append(self, other: "StagedBlock"):
+        """add other's code to the end of this block, as evaluate_tools
+        joins consecutive code blocks"""
+        with open(self.path, "a") as file, open(other.path) as extra:
+            for data in iter(lambda: extra.read(1 << 16), ""):
+                file.write(data)
+        self.size += other.size
+        os.unlink(other.path)
+
+
+class BlockSink:
+    """splits a streamed reply into commands and staged code blocks"""
+    staging: str
+    state: str
+    pending: str
+    text: str
+    block: StagedBlock|None
+    file: typing.TextIO|None
+    json: str
+    staged: list[StagedBlock]
+
+    def __init__(self, staging: str):
+        self.staging = staging
+        # "text" between blocks, "header" in a fence's language line,
+        # "body" inside a block and "json" inside a json block
+        self.state = "text"
+        # received but not yet handled, e.g. what may be half a fence
+        self.pending = ""
+        # text since the last block, scanned for commands at the next one
+        self.text = ""
+        self.block = None
+        self.file = None
+        self.json = ""
+        self.staged = []
+
+    def feed(self, chunk: str) -> list[typing.Any]:
+        """handle the next chunk of the reply and return any elements it
+        completed"""
+        self.pending += chunk
+        elements = []
+        while True:
+            if self.state == "text":
+                start = self.pending.find(FENCE)
+                if start < 0:
+                    # keep what could be the start of a fence
+                    keep = len(self.pending) - len(FENCE) + 1
+                    if keep > 0:
+                        self.text += self.pending[:keep]
+                        self.pending = self.pending[keep:]
+                    break
+                self.text += self.pending[:start]
+                self.pending = self.pending[start + len(FENCE):]
+                elements.extend(detector.JSONMDParser().scan(self.text))
+                self.state = "header"
+            elif self.state == "header":
+                end = self.pending.find("\n")
+                if end < 0:
+                    break
+                language = self.pending[:end] or None
+                self.pending = self.pending[end + 1:]
+                if language == "json":
+                    self.state = "json"
+                else:
+                    self._open(language)
+                    self.state = "body"
+                self.text = ""
+            else:
+                end = self.pending.find(FENCE)
+                if end < 0:
+                    keep = len(self.pending) - len(FENCE) + 1
+                    if keep > 0:
+                        self._write(self.pending[:keep])
+                        self.pending = self.pending[keep:]
+                    break
+                self._write(self.pending[:end])
+                self.pending = self.pending[end + len(FENCE):]
+                elements.append(self._finish())
+                self.state = "text"
+        return elements
+
+    def close(self) -> list[typing.Any]:
+        """handle the end of the reply, returning the last elements. an
+        unterminated block is dropped"""
+        elements = []
+        if self.state == "text":
+            self.text += self.pending
+            elements.extend(detector.JSONMDParser().scan(self.text))
+        elif self.file is not None:
+            self.file.close()
+            self.file = None
+        self.state = "text"
+        self.pending = self.text = self.json = ""
+        return elements
+
+    def discard(self):
+        """delete the staging files of blocks that were never moved"""
+        for block in self.staged:
+            try:
+                os.unlink(block.path)
+            except FileNotFoundError:
+                pass
+        self.staged = []
+
+    def _open(self, language: str|None):
+        os.makedirs(self.staging, exist_ok=True)
+        fd, path = tempfile.mkstemp(dir=self.staging, prefix="block-")
+        lines = self.text.rstrip("\n").rsplit("\n", 1)
+        self.block = StagedBlock(language, path, lines[-1].strip())
+        self.file = os.fdopen(fd, "w")
+        self.staged.append(self.block)
+
+    def _write(self, text: str):
+        if self.state == "json":
+            self.json += text
+        else:
+            self.file.write(text)
+            self.block.size += len(text)
+
+    def _finish(self) -> StagedBlock|detector.CodeBlock:
+        if self.state == "json":
+            element = detector.CodeBlock("json", self.json)
+            self.json = ""
+            return element
+        self.file.close()
+        self.file = None
+        return self.block
@@ -0,0 +1,221 @@
+"""content addressed snapshots of a workspace so a turn can be rolled back"""
+
+import dataclasses
+import hashlib
+import json
+import os
+import shutil
+
+from . import fsutil
+from . import metrics
+
+
+STORE_DIR = ".snapshots"
+
+
+def hash_file(path: str) -> str:
+    """sha256 of a file's content"""
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        for block in iter(lambda: file.read(1 << 16), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+@dataclasses.dataclass
+class ManifestEntry:
+    """a file as recorded in a snapshot"""
+    blob: str
+    size: int
+    mtime_ns: int
+    mode: int
+
+    def matches(self, stat: os.stat_result) -> bool:
+        """true if stat says the file is unchanged since it was recorded"""
+        return self.size == stat.st_size and self.mtime_ns == stat.st_mtime_ns
+
+
+@dataclasses.dataclass
+class Snapshot:
+    """the state of the workspace at the end of a turn"""
+    turn: int
+    files: dict[str, ManifestEntry]
+    meta: dict
+
+    def to_json(self) -> dict:
+        return {
+            "turn": self.turn,
+            "meta": self.meta,
+            "files": {path: dataclasses.astuple(entry) for path, entry in self.files.items()},
+        }
+
+    @classmethod
+    def from_json(cls, data: dict) -> "Snapshot":
+        return cls(
+            turn=data["turn"],
+            meta=data["meta"],
+            files={path: ManifestEntry(*entry) for path, entry in data["files"].items()},
+        )
+
+
+class SnapshotStore:
+    """records the workspace after each turn as a manifest of content
+    addressed blobs stored under root/.snapshots.
+
+    identical content is stored once no matter how many turns or paths
+    reference it, so a snapshot only costs disk for files that changed.
+    a stat cache (size and mtime) means only changed files are hashed,
+    which makes both snapshot and rollback proportional to the number of
+    changed files rather than the size of the workspace. blobs are copied
+    rather than hard linked so an in place edit of a workspace file can
+    never corrupt history"""
+    root: str
+    ignore: set[str]
+    known: dict[str, ManifestEntry]
+
+    def __init__(self, root: str, ignore: set[str]|None = None):
+        self.root = root
+        self.ignore = ignore or set()
+        self.known = {}
+        os.makedirs(self._objects(), exist_ok=True)
+        os.makedirs(self._turns(), exist_ok=True)
+        turns = self.turns()
+        if turns:
+            self.known = dict(self.load(turns[-1]).files)
+
+    def _objects(self) -> str:
+        return os.path.join(self.root, STORE_DIR, "objects")
+
+    def _turns(self) -> str:
+        return os.path.join(self.root, STORE_DIR, "turns")
+
+    def _blob_path(self, blob: str) -> str:
+        return os.path.join(self._objects(), blob[:2], blob[2:])
+
+    def _manifest_path(self, turn: int) -> str:
+        return os.path.join(self._turns(), f"{turn}.json")
+
+    def _store_blob(self, path: str) -> str:
+        blob = hash_file(path)
+        blob_path = self._blob_path(blob)
+        if not os.path.exists(blob_path):
+            # a crash must never leave a truncated blob behind
+            with fsutil.atomic_replace(blob_path, mode=0o444) as tmp_path:
+                shutil.copyfile(path, tmp_path)
+        return blob
+
+    def digest(self, rel_path: str) -> str|None:
+        """sha256 of a workspace file, None if it doesn't exist. the file
+        is only read if it changed since it was last hashed"""
+        path = os.path.join(self.root, rel_path)
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return None
+        entry = self.known.get(os.path.normpath(rel_path))
+        if entry is not None and entry.matches(stat):
+            return entry.blob
+        return hash_file(path)
+
+    def scan(self) -> dict[str, ManifestEntry]:
+        """the current state of the workspace, hashing only files whose
+        stat changed since we last looked at them"""
+        files = {}
+        for rel_path, stat in fsutil.walk_files(self.root, self.ignore):
+            entry = self.known.get(rel_path)
+            if entry is None or not entry.matches(stat):
+                blob = self._store_blob(os.path.join(self.root, rel_path))
+                entry = ManifestEntry(blob, stat.st_size, stat.st_mtime_ns, stat.st_mode & 0o777)
+            files[rel_path] = entry
+        self.known = files
+        return files
+
+    def turns(self) -> list[int]:
+        """the turns that have snapshots, oldest first"""
+        return sorted(
+            int(name[:-len(".json")])
+            for name in os.listdir(self._turns())
+            if name.endswith(".json")
+        )
+
+    def load(self, turn: int) -> Snapshot:
+        """read the manifest for a turn"""
+        try:
+            with open(self._manifest_path(turn)) as file:
+                return Snapshot.from_json(json.load(file))
+        except FileNotFoundError:
+            raise ValueError(f"no snapshot for turn {turn}") from None
+
+    def snapshot(self, turn: int, **meta) -> Snapshot:
+        """record the current workspace as the state at the end of turn.
+        meta is stored alongside the manifest for the caller's use"""
+        with metrics.span("snapshot"):
+            snapshot = Snapshot(turn=turn, files=self.scan(), meta=meta)
+            with open(self._manifest_path(turn), "w") as file:
+                json.dump(snapshot.to_json(), file)
+        return snapshot
+
+    def _restore(self, rel_path: str, entry: ManifestEntry) -> ManifestEntry:
+        path = os.path.join(self.root, rel_path)
+        with fsutil.atomic_replace(path, mode=entry.mode) as tmp_path:
+            shutil.copyfile(self._blob_path(entry.blob), tmp_path)
+        stat = os.stat(path)
+        return ManifestEntry(entry.blob, stat.st_size, stat.st_mtime_ns, entry.mode)
+
+    def rollback(self, turn: int) -> list[str]:
+        """restore the workspace to the state recorded at the end of turn
+        and forget every later turn. returns the paths that changed"""
+        target = self.load(turn)
+        current = self.scan()
+        changed = []
+        # deletions first: a file may be in the way of a directory, or a
+        # directory in the way of a file, that the target needs
+        for rel_path in current.keys() - target.files.keys():
+            os.unlink(os.path.join(self.root, rel_path))
+            del self.known[rel_path]
+            self._remove_empty_parents(rel_path)
+            changed.append(rel_path)
+        for rel_path, entry in target.files.items():
+            existing = current.get(rel_path)
+            if existing is not None and existing.blob == entry.blob and existing.mode == entry.mode:
+                continue
+            path = os.path.join(self.root, rel_path)
+            if os.path.isdir(path) and not os.path.islink(path):
+                # only ignored files can be left in it
+                shutil.rmtree(path)
+            self.known[rel_path] = self._restore(rel_path, entry)
+            changed.append(rel_path)
+        self.truncate(turn)
+        return sorted(changed)
+
+    def _remove_empty_parents(self, rel_path: str):
+        directory = os.path.dirname(rel_path)
+        while directory:
+            try:
+                os.rmdir(os.path.join(self.root, directory))
+            except OSError:
+                return
+            directory = os.path.dirname(directory)
+
+    def truncate(self, turn: int):
+        """forget every snapshot after turn, and the blobs only they used"""
+        discarded = [later for later in self.turns() if later > turn]
+        for later in discarded:
+            os.unlink(self._manifest_path(later))
+        if discarded:
+            self.prune()
+
+    def prune(self) -> int:
+        """delete blobs no snapshot references, e.g. those only used by
+        turns discarded by a rollback. returns how many were deleted"""
+        referenced = set()
+        for turn in self.turns():
+            referenced.update(entry.blob for entry in self.load(turn).files.values())
+        removed = 0
+        for prefix in os.listdir(self._objects()):
+            directory = os.path.join(self._objects(), prefix)
+            for name in os.listdir(directory):
+                if prefix + name not in referenced:
+                    os.unlink(os.path.join(directory, name))
+                    removed += 1
+        return removed
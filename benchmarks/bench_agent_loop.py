@@ -0,0 +1,121 @@
+"""replay a recorded session through StatefulChat and report where each
+turn's time goes: waiting on the (replayed) model versus local work such
+as parsing, tool dispatch, shell commands and persistence
+
+record a cassette with `python chat.py ${project} --record session.jsonl`
+or let this script synthesize one.
+
+usage: python benchmarks/bench_agent_loop.py [--cassette session.jsonl] [--speed 1]
+"""
+
+import argparse
+import asyncio
+import os
+import shutil
+import sys
+import tempfile
+import time
+import typing
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from agent import backend, fakes, llm, shell  # noqa: E402
+
+
+TEMPLATE = os.path.join(os.path.dirname(__file__), "..", "isolation_env", "python", "template")
+
+
+class TimedBackend:
+    """measures how long the agent loop spends waiting on chunks"""
+    backend: backend.Backend
+    waited: float
+
+    def __init__(self, completions: backend.Backend):
+        self.backend = completions
+        self.waited = 0.0
+
+    async def stream(self, messages: list[dict], system: str) -> typing.AsyncIterator[str]:
+        chunks = self.backend.stream(messages, system).__aiter__()
+        while True:
+            start = time.perf_counter()
+            try:
+                text = await anext(chunks)
+            except StopAsyncIteration:
+                self.waited += time.perf_counter() - start
+                return
+            self.waited += time.perf_counter() - start
+            yield text
+
+
+def words(text: str, first_delay: float, delay: float) -> list[tuple[float, str]]:
+    """a reply streamed a word at a time"""
+    split = text.split(" ")
+    return [
+        (first_delay if n == 0 else delay, word if n == len(split) - 1 else word + " ")
+        for n, word in enumerate(split)
+    ]
+
+
+def synthesize(turns: int, lines: int) -> list[backend.Exchange]:
+    """each turn writes a module, checks the tests and then finishes"""
+    exchanges = []
+    for turn in range(turns):
+        code = "\n".join(f"def function_{turn}_{n}(value):\n    return value + {n}\n" for n in range(lines))
+        reply = (
+            f"Here is module {turn}.\n```python\n{code}```\n"
+            f'{{"command": "write_file", "path": "src/module_{turn}.py"}}\n'
+            f'{{"command": "check_tests"}}'
+        )
+        exchanges.append(backend.Exchange("", f"write module {turn}", words(reply, 0.3, 0.002)))
+        exchanges.append(backend.Exchange("", "OBSERVATION: ...", words("All done.", 0.3, 0.002)))
+    return exchanges
+
+
+async def main():
+    args = argparse.ArgumentParser()
+    args.add_argument("--cassette", help="recorded session to replay, synthesized if omitted")
+    args.add_argument("--speed", default="1",
+                      help="multiple of the recorded speed to replay at, or max for no waiting")
+    args.add_argument("--turns", type=int, default=5, help="turns in a synthesized session")
+    args.add_argument("--lines", type=int, default=50, help="functions per synthesized module")
+    args.add_argument("--docker", action="store_true",
+                      help="run tool commands in the real isolation shell instead of a fake")
+    args = args.parse_args()
+
+    if args.cassette:
+        exchanges = backend.load_cassette(args.cassette)
+    else:
+        exchanges = synthesize(args.turns, args.lines)
+    prompts = [
+        exchange.prompt for exchange in exchanges
+        if not exchange.prompt.startswith("OBSERVATION")
+    ]
+    speed = None if args.speed == "max" else float(args.speed)
+    timed = TimedBackend(backend.ReplayBackend(exchanges, speed))
+
+    with tempfile.TemporaryDirectory() as root:
+        workspace = os.path.join(root, "workspace")
+        shutil.copytree(TEMPLATE, workspace)
+        sh = shell.Shell(workspace, shell.python_isolation) if args.docker else fakes.FakeShell()
+        chat = llm.StatefulChat(system_prompt="", base_path=workspace, completions=timed, sh=sh)
+
+        print(f"{'turn':>4} {'wall ms':>10} {'model ms':>10} {'local ms':>10}")
+        total_wall = total_model = 0.0
+        for turn, prompt in enumerate(prompts):
+            timed.waited = 0.0
+            start = time.perf_counter()
+            async for _ in chat.interact(prompt):
+                pass
+            wall = time.perf_counter() - start
+            total_wall += wall
+            total_model += timed.waited
+            print(f"{turn:>4} {wall * 1000:10.1f} {timed.waited * 1000:10.1f} {(wall - timed.waited) * 1000:10.1f}")
+        chat.close()
+
+    local = total_wall - total_model
+    print(f"{'all':>4} {total_wall * 1000:10.1f} {total_model * 1000:10.1f} {local * 1000:10.1f}")
+    print(f"local overhead is {local / total_wall:.1%} of wall time")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,150 @@
+"""compare the wall clock time to passing tests of a single attempt with a
+fan out over several branches, with the model replayed from cassettes
+
+every branch is a synthesized session that keeps rewriting src/answer.py
+and checking the tests until one of its attempts is right. how many
+attempts a branch needs is random, so some branches get there sooner.
+branch 0 on its own is the baseline. the tests run for real, with the
+local python rather than in the isolation container, so on a machine
+with fewer cores than branches they slow each other down. --test-seconds
+instead pretends each run takes that long without using this machine's
+cpu, as when every branch's container has a core of its own.
+
+usage: python benchmarks/bench_fanout.py [--branches 4] [--speed 1]
+"""
+
+import argparse
+import asyncio
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from agent import backend, fanout, llm, shell  # noqa: E402
+from bench_agent_loop import TEMPLATE, words  # noqa: E402
+
+
+TEST = "from src.answer import answer\n\n\ndef test_answer():\n    assert answer() == 42\n"
+
+
+class LocalShell:
+    """runs check_tests with the local python, ignores other commands"""
+    workspace: str
+    test_seconds: float|None
+
+    def __init__(self, workspace: str, test_seconds: float|None = None):
+        self.workspace = workspace
+        self.test_seconds = test_seconds
+
+    def run(self, line: str, timeout=-1) -> shell.ShellResponse:
+        if line != llm.TEST_COMMAND:
+            return shell.ShellResponse("", 0)
+        if self.test_seconds is not None:
+            time.sleep(self.test_seconds)
+            with open(os.path.join(self.workspace, "src", "answer.py")) as file:
+                if "return 42" in file.read():
+                    return shell.ShellResponse("1 passed", 0)
+            return shell.ShellResponse("1 failed", 1)
+        result = subprocess.run(
+            [sys.executable, "-m", "pytest", "-q", "-p", "no:cacheprovider"],
+            cwd=self.workspace, capture_output=True, text=True,
+            env={**os.environ, "PYTHONDONTWRITEBYTECODE": "1"},
+        )
+        return shell.ShellResponse(result.stdout + result.stderr, result.returncode)
+
+    def interrupt(self):
+        pass
+
+    def close(self):
+        pass
+
+
+def synthesize(rng: random.Random, success: float, max_attempts: int) -> list[backend.Exchange]:
+    """attempts that each get the answer right with probability success"""
+    exchanges = []
+    for attempt in range(max_attempts):
+        right = rng.random() < success or attempt == max_attempts - 1
+        value = 42 if right else rng.randrange(42)
+        reply = (
+            f"Attempt {attempt}.\n```python\ndef answer():\n    return {value}\n```\n"
+            f'{{"command": "write_file", "path": "src/answer.py"}}\n'
+            f'{{"command": "check_tests"}}'
+        )
+        exchanges.append(backend.Exchange("", "OBSERVATION: ...", words(reply, 0.5, 0.005)))
+        if right:
+            break
+    exchanges.append(backend.Exchange("", "OBSERVATION: ...", words("All green.", 0.5, 0.005)))
+    return exchanges
+
+
+def make_chat(root: str, exchanges: list[backend.Exchange], speed: float|None,
+              test_seconds: float|None) -> llm.StatefulChat:
+    workspace = os.path.join(root, "workspace")
+    shutil.copytree(TEMPLATE, workspace)
+    with open(os.path.join(workspace, "tests", "test_answer.py"), "w") as file:
+        file.write(TEST)
+    return llm.StatefulChat(
+        system_prompt="",
+        base_path=workspace,
+        completions=backend.ReplayBackend(exchanges, speed),
+        sh=LocalShell(workspace, test_seconds),
+    )
+
+
+async def main():
+    args = argparse.ArgumentParser()
+    args.add_argument("--branches", type=int, default=4)
+    args.add_argument("--success", type=float, default=0.25,
+                      help="chance that any one attempt gets the answer right")
+    args.add_argument("--max-attempts", type=int, default=8)
+    args.add_argument("--speed", default="1",
+                      help="multiple of the synthesized speed to replay at, or max for no waiting")
+    args.add_argument("--test-seconds", type=float,
+                      help="simulate test runs of this length instead of running pytest")
+    args.add_argument("--seed", type=int, default=1)
+    args = args.parse_args()
+
+    rng = random.Random(args.seed)
+    cassettes = [synthesize(rng, args.success, args.max_attempts) for _ in range(args.branches)]
+    speed = None if args.speed == "max" else float(args.speed)
+    prompt = "make the tests pass"
+
+    with tempfile.TemporaryDirectory() as root:
+        chat = make_chat(root, cassettes[0], speed, args.test_seconds)
+        start = time.perf_counter()
+        async for _ in chat.interact(prompt):
+            pass
+        passed = (chat.tests or chat.run_shell(llm.TEST_COMMAND)).return_code == 0
+        baseline = time.perf_counter() - start
+        baseline_requests = len(cassettes[0])
+        chat.close()
+
+    with tempfile.TemporaryDirectory() as root:
+        chat = make_chat(root, [], speed, args.test_seconds)
+        start = time.perf_counter()
+        branches = await fanout.fan_out(
+            chat, prompt, args.branches,
+            make_completions=lambda number: backend.ReplayBackend(cassettes[number], speed),
+            make_shell=lambda workspace: LocalShell(workspace, args.test_seconds),
+        )
+        fanned = time.perf_counter() - start
+        fanned_requests = sum(len(branch.chat.chat.transcript) // 2 for branch in branches)
+        chat.close()
+
+    attempts = [len(cassette) - 1 for cassette in cassettes]
+    print(f"attempts per branch      {attempts}")
+    print(f"single branch            {baseline:.2f} s to {'green' if passed else 'red'}, "
+          f"{baseline_requests / baseline:.1f} model requests/s")
+    print(f"fan out over {args.branches:<3}         {fanned:.2f} s to "
+          f"{'green' if branches[0].passed else 'red'} (branch {branches[0].number}), "
+          f"at least {fanned_requests / fanned:.1f} model requests/s")
+    print(f"speedup                  {baseline / fanned:.2f}x")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
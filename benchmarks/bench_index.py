@@ -0,0 +1,94 @@
+"""benchmark the workspace search index on a synthetic tree
+
+usage: python benchmarks/bench_index.py [--files 10000]
+"""
+
+import argparse
+import os
+import random
+import re
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from agent.index import WorkspaceIndex  # noqa: E402
+
+
+WORDS = [
+    "request", "response", "session", "handler", "parse", "render", "config",
+    "value", "result", "buffer", "stream", "client", "server", "token", "cache",
+]
+
+
+def synthesize(root: str, count: int, seed: int = 0):
+    """write count python-ish files spread over a directory tree"""
+    rng = random.Random(seed)
+    for n in range(count):
+        directory = os.path.join(root, f"pkg{n % 50}", f"mod{n % 7}")
+        os.makedirs(directory, exist_ok=True)
+        lines = []
+        for f in range(rng.randint(5, 20)):
+            name = "_".join(rng.sample(WORDS, 2)) + f"_{n}_{f}"
+            lines.append(f"def {name}({rng.choice(WORDS)}):")
+            for _ in range(rng.randint(2, 8)):
+                lines.append(f"    {rng.choice(WORDS)} = {rng.choice(WORDS)}({rng.randint(0, 999)})")
+            lines.append("")
+        with open(os.path.join(directory, f"file{n}.py"), "w") as file:
+            file.write("\n".join(lines))
+
+
+def naive_search(root: str, matcher: re.Pattern) -> int:
+    """what the model has without an index: read everything"""
+    hits = 0
+    for directory, _, files in os.walk(root):
+        for name in files:
+            with open(os.path.join(directory, name)) as file:
+                for line in file:
+                    if matcher.search(line):
+                        hits += 1
+    return hits
+
+
+def timed(label: str, fn):
+    start = time.perf_counter()
+    result = fn()
+    elapsed = time.perf_counter() - start
+    print(f"{label:<40} {elapsed * 1000:10.1f} ms")
+    return result
+
+
+def main():
+    args = argparse.ArgumentParser()
+    args.add_argument("--files", type=int, default=10000)
+    args = args.parse_args()
+
+    with tempfile.TemporaryDirectory() as root:
+        timed(f"synthesize {args.files} files", lambda: synthesize(root, args.files))
+        index = WorkspaceIndex(root)
+        timed("initial index build", index.refresh)
+        timed("refresh with no changes", index.refresh)
+
+        target = os.path.join("pkg3", "mod3", "file3.py")
+        with open(os.path.join(root, target), "a") as file:
+            file.write("\ndef needle_in_haystack():\n    pass\n")
+        timed("update one written file", lambda: index.update(target))
+        timed("refresh after one change", index.refresh)
+
+        queries = [
+            ("text", "needle_in_haystack"),
+            ("identifier", "needle_in_haystack"),
+            ("regex", r"def\s+needle_\w+"),
+            ("text", "session_token_4242"),
+        ]
+        for kind, pattern in queries:
+            hits = timed(f"indexed {kind} {pattern[:20]}",
+                         lambda: index.search(pattern, kind=kind))
+            matcher = re.compile(pattern if kind == "regex" else re.escape(pattern))
+            naive = timed(f"naive scan {pattern[:20]}", lambda: naive_search(root, matcher))
+            print(f"  {len(hits)} indexed hits, {naive} naive hits")
+
+
+if __name__ == "__main__":
+    main()
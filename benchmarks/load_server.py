@@ -0,0 +1,98 @@
+"""load test the session server against a fake model backend
+
+every session runs a number of turns over http. each turn asks for a
+tool (exercising the tool path and the shell cap) and then finishes, so
+a turn is two model requests. the model streams words with a fixed delay,
+which is the time a real session spends waiting on the api. the report
+divides the process cpu time by wall time to estimate how many sessions
+one core sustains at this pace.
+
+usage: python benchmarks/load_server.py [--sessions 200] [--turns 5]
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from agent import fakes, llm  # noqa: E402
+import server  # noqa: E402
+
+
+RESPONSE_WORDS = 200
+
+
+def respond(messages: list[dict]) -> str:
+    """alternate between asking for a tool and finishing the turn"""
+    filler = " ".join(["word"] * RESPONSE_WORDS)
+    if messages[-1]["content"].startswith("OBSERVATION"):
+        return filler + " done"
+    return filler + '\n{"command": "check_tests"}'
+
+
+async def run_session(port: int, turns: int, latencies: list[float]):
+    status, body = await server.fetch("127.0.0.1", port, "POST", "/sessions")
+    assert status == 200, body
+    session_id = json.loads(body)["id"]
+    for turn in range(turns):
+        start = time.perf_counter()
+        status, body = await server.fetch(
+            "127.0.0.1", port, "POST", f"/sessions/{session_id}/messages", f"turn {turn}",
+        )
+        assert status == 200, body
+        latencies.append(time.perf_counter() - start)
+
+
+async def main():
+    args = argparse.ArgumentParser()
+    args.add_argument("--sessions", type=int, default=200)
+    args.add_argument("--turns", type=int, default=5)
+    args.add_argument("--word-delay", type=float, default=0.002,
+                      help="seconds the fake model waits before each word")
+    args.add_argument("--model-requests", type=int, default=64)
+    args.add_argument("--shell-commands", type=int, default=16)
+    args = args.parse_args()
+
+    completions = fakes.FakeBackend(respond, delay=args.word_delay)
+    limits = llm.Limits.create(args.model_requests, args.shell_commands)
+    with tempfile.TemporaryDirectory() as root:
+        hosted = server.Server(root, lambda workspace: llm.StatefulChat(
+            system_prompt="",
+            base_path=workspace,
+            completions=completions,
+            sh=fakes.FakeShell(),
+            limits=limits,
+        ))
+        listener = await server.serve(hosted, "127.0.0.1", 0)
+        port = listener.sockets[0].getsockname()[1]
+        latencies = []
+        async with listener:
+            wall = time.perf_counter()
+            cpu = time.process_time()
+            await asyncio.gather(*(
+                run_session(port, args.turns, latencies) for _ in range(args.sessions)
+            ))
+            cpu = time.process_time() - cpu
+            wall = time.perf_counter() - wall
+            await hosted.close()
+
+    latencies.sort()
+    turns = len(latencies)
+    print(f"sessions                {args.sessions}")
+    print(f"turns                   {turns}")
+    print(f"wall time               {wall:.2f} s")
+    print(f"cpu time                {cpu:.2f} s ({cpu / wall:.0%} of one core)")
+    print(f"turns per second        {turns / wall:.1f}")
+    print(f"cpu per turn            {cpu / turns * 1000:.2f} ms")
+    print(f"turn latency p50 / p99  {latencies[turns // 2]:.3f} / {latencies[int(turns * 0.99)]:.3f} s")
+    print(f"peak model requests     {completions.peak_in_flight} (cap {args.model_requests})")
+    print(f"sessions per core       {args.sessions * wall / cpu:.0f}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -3,12 +3,44 @@
 import sys
 import asyncio
 import argparse
+import json
 import os
-import re
 import shutil
+import signal
+import typing
 
+import anthropic
+import dotenv
+
+import agent.backend as backend
+import agent.fanout as fanout
+import agent.fsutil as fsutil
 import agent.llm as llm
-from agent.detector import Detector
+import agent.metrics as metrics
+import agent.scheduler as scheduler
+import agent.sink as sink
+
+async def consult(completions: backend.Backend, system: str, outdir: str,
+                  transcript: list[dict], prompt: str) -> typing.AsyncIterator[str]:
+    """send prompt after transcript and stream the reply. a code block
+    headed by #### and a file name is moved into outdir as soon as its
+    closing fence arrives"""
+    transcript.append({"role": "user", "content": prompt})
+    blocks = sink.BlockSink(os.path.join(outdir, llm.STAGING_DIR))
+    completion = ""
+    try:
+        async for chunk in completions.stream(transcript, system):
+            for element in blocks.feed(chunk):
+                if isinstance(element, sink.StagedBlock) and element.heading.startswith("####"):
+                    filename = element.heading[len("####"):].strip()
+                    fsutil.replace_with(element.path, os.path.join(outdir, filename))
+            completion += chunk
+            yield chunk
+        blocks.close()
+    finally:
+        blocks.discard()
+        transcript.append({"role": "assistant", "content": completion})
+
 
 async def main2():
     """main function"""
@@ -20,51 +52,18 @@ async def main2():
     if not os.path.exists(args.outdir):
         os.makedirs(args.outdir)
 
-    matcher = re.compile(r"```.*?\n(.*?)```", re.DOTALL)
-
-    def on_wake(suffix):
-        """extract the code between the ``` markers and write it to disk"""
-        match = matcher.search(suffix)
-        if match:
-            # the first line of the suffix should be the file name
-            filename = suffix.split("\n")[0]
-            path = os.path.join(args.outdir, filename)
-
-            # ensure the destination directory exists
-            subdir, _ = os.path.split(path)
-            if not os.path.exists(subdir):
-                os.makedirs(subdir)
-
-            with open(path, "w") as file:
-                file.write(match.group(1))
-
-            return False
-        return True
-    
+    dotenv.load_dotenv()
+    client = anthropic.AsyncAnthropic(api_key=os.environ["ANTHROPIC_API_KEY"], max_retries=0)
+    completions = scheduler.ScheduledBackend(backend.AnthropicBackend(client), scheduler.Scheduler(), args.outdir)
     system = open(args.prompt).read()
     transcript = []
     while True:
         prompt = input("> ")
         if not prompt:
             break
-        transcript.append({"role": "client", "content": prompt})
-        prefix = system + "\n\n" + "\n".join([
-            f"{item['role']}: {item['content']}"
-            for item in transcript
-            if item["role"] != "system"
-        ])
-
-        detector = Detector(
-            llm.agenerate(prefix),
-            "####",
-            on_wake,
-        )
-        completion = ""
-        async for chunk in detector:
-            completion += chunk
+        async for chunk in consult(completions, system, args.outdir, transcript, prompt):
             sys.stdout.write(chunk)
             sys.stdout.flush()
-        transcript.append({"role": "consultant", "content": completion})
 
 
 async def main():
@@ -72,22 +71,116 @@ async def main():
     args = argparse.ArgumentParser()
     args.add_argument("outdir")
     args.add_argument("--prompt", default="consultant.prompt")
+    args.add_argument("--record", help="append every model exchange to this cassette file")
+    args.add_argument("--replay", help="answer from this cassette file instead of the api")
+    args.add_argument("--replay-speed", default="1",
+                      help="multiple of the recorded speed to replay at, or max for no waiting")
+    args.add_argument("--trace", help="write every timing span of the session to this file")
+    args.add_argument("--metrics", help="write timing histograms to this json file on exit")
+    args.add_argument("--tool-timeout", type=float, default=300.0,
+                      help="seconds a shell command may run before it is interrupted")
+    args.add_argument("--turn-timeout", type=float,
+                      help="seconds a turn may take before it is stopped")
     args = args.parse_args()
+    metrics.enable(bool(args.trace or args.metrics))
 
     if not os.path.exists(args.outdir):
         shutil.copytree('isolation_env/python/template/', args.outdir)
-    
+
+    completions = None
+    if args.replay:
+        speed = None if args.replay_speed == "max" else float(args.replay_speed)
+        completions = backend.ReplayBackend.from_file(args.replay, speed)
+    elif args.record:
+        dotenv.load_dotenv()
+        client = anthropic.AsyncAnthropic(api_key=os.environ["ANTHROPIC_API_KEY"], max_retries=0)
+        completions = backend.RecordingBackend(
+            scheduler.ScheduledBackend(backend.AnthropicBackend(client), scheduler.Scheduler(), args.outdir),
+            args.record,
+        )
+
     chat = llm.StatefulChat(
         system_prompt=open(args.prompt).read(),
         base_path=args.outdir,
+        completions=completions,
+        trace=args.trace,
+        tool_timeout=args.tool_timeout,
+        turn_timeout=args.turn_timeout,
     )
+    try:
+        await repl(chat)
+    finally:
+        chat.close()
+        if args.metrics:
+            with open(args.metrics, "w") as file:
+                json.dump(metrics.REGISTRY.to_json(), file, indent=2)
+
+
+async def repl(chat: llm.StatefulChat):
+    """prompt the user until they enter an empty line"""
     while True:
         prompt = input("> ")
         if not prompt:
             break
-        async for chunk in chat.interact(prompt):
-            sys.stdout.write(chunk)
-            sys.stdout.flush()
+        if prompt.startswith("/rewind"):
+            # /rewind N restores the workspace and transcript to the end of turn N
+            try:
+                changed = chat.rewind(int(prompt.split()[1]))
+            except (IndexError, ValueError) as exc:
+                print(f"usage: /rewind TURN (turns: {chat.snapshots.turns()}): {exc}")
+                continue
+            except OSError as exc:
+                print(f"rewind failed: {exc}")
+                continue
+            print(f"rewound to turn {chat.turn}, restored {len(changed)} files")
+            continue
+        if prompt.startswith("/fanout"):
+            # /fanout N PROMPT tries PROMPT in N copies of the workspace at
+            # once and keeps the first whose tests pass, or the best
+            try:
+                _, count, prompt = prompt.split(maxsplit=2)
+                count = int(count)
+            except ValueError as exc:
+                print(f"usage: /fanout BRANCHES PROMPT: {exc}")
+                continue
+            try:
+                branches = await cancellable(fanout.fan_out(chat, prompt, count))
+            except asyncio.CancelledError:
+                print(llm.INTERRUPTED)
+                continue
+            except Exception as exc:
+                print(f"fan out failed: {exc}")
+                continue
+            for branch in branches:
+                summary = (branch.tests.output.strip().splitlines() or [""])[-1]
+                print(f"branch {branch.number}: {summary} ({branch.seconds:.1f}s)")
+            print(f"kept branch {branches[0].number} as turn {chat.turn}")
+            continue
+        try:
+            await cancellable(print_turn(chat, prompt))
+        except asyncio.CancelledError:
+            print(llm.INTERRUPTED)
+        except Exception as exc:
+            # the transcript still alternates, the session can carry on
+            print(f"\n[failed: {exc}]")
+
+
+async def cancellable(work: typing.Awaitable[typing.Any]) -> typing.Any:
+    """await work as a task that ctrl-c cancels, rather than ending the
+    program"""
+    loop = asyncio.get_running_loop()
+    task = asyncio.ensure_future(work)
+    loop.add_signal_handler(signal.SIGINT, task.cancel)
+    try:
+        return await task
+    finally:
+        loop.remove_signal_handler(signal.SIGINT)
+
+
+async def print_turn(chat: llm.StatefulChat, prompt: str):
+    async for chunk in chat.interact(prompt):
+        sys.stdout.write(chunk)
+        sys.stdout.flush()
 
 if __name__ == '__main__':
     asyncio.run(main())
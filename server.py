@@ -0,0 +1,348 @@
+"""asyncio http server hosting many chat sessions in one process
+
+    GET    /metrics                histograms in prometheus text format
+    GET    /metrics.json           the same histograms as json
+    POST   /sessions               create a session, returns {"id": ...}
+    POST   /sessions/{id}/messages send the request body as a prompt and
+                                   stream the response as chunked text
+    POST   /sessions/{id}/interrupt stop the turn in progress, the session
+                                   stays open
+    DELETE /sessions/{id}          close a session
+"""
+
+import argparse
+import asyncio
+import dataclasses
+import json
+import os
+import shutil
+import typing
+import uuid
+
+import anthropic
+import dotenv
+
+import agent.backend as backend
+import agent.llm as llm
+import agent.metrics as metrics
+import agent.scheduler as scheduler
+
+
+TEMPLATE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "isolation_env", "python", "template")
+
+# how much unsent response we let a slow reader accumulate before we
+# stop pulling from the model for that session
+WRITE_BUFFER_HIGH = 64 * 1024
+
+REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed", 409: "Conflict"}
+
+
+@dataclasses.dataclass
+class Session:
+    """a hosted chat and the lock serializing its turns"""
+    id: str
+    chat: llm.StatefulChat
+    lock: asyncio.Lock = dataclasses.field(default_factory=asyncio.Lock)
+    # the task streaming the current turn, and whether it was interrupted
+    turn: asyncio.Task|None = None
+    interrupted: bool = False
+
+    def interrupt(self) -> bool:
+        """cancel the turn in progress. false if there isn't one"""
+        if self.turn is None:
+            return False
+        self.interrupted = True
+        self.turn.cancel()
+        return True
+
+
+@dataclasses.dataclass
+class Request:
+    method: str
+    path: str
+    headers: dict[str, str]
+    body: bytes
+
+
+class HTTPError(Exception):
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+
+
+async def read_request(reader: asyncio.StreamReader) -> Request|None:
+    """parse one http/1.1 request, None if the client went away"""
+    line = await reader.readline()
+    if not line:
+        return None
+    try:
+        method, path, _ = line.decode().split(" ", 2)
+    except ValueError:
+        raise HTTPError(400, "malformed request line") from None
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        name, _, value = line.decode().partition(":")
+        headers[name.strip().lower()] = value.strip()
+    try:
+        length = int(headers.get("content-length", 0))
+    except ValueError:
+        length = -1
+    if length < 0:
+        raise HTTPError(400, "malformed content-length")
+    body = await reader.readexactly(length)
+    return Request(method, path, headers, body)
+
+
+async def respond(writer: asyncio.StreamWriter, status: int, body: typing.Any):
+    """send a complete json response"""
+    await respond_text(writer, status, json.dumps(body), "application/json")
+
+
+async def respond_text(writer: asyncio.StreamWriter, status: int, body: str,
+                       content_type: str = "text/plain; charset=utf-8"):
+    """send a complete response"""
+    data = body.encode()
+    writer.write(
+        f"HTTP/1.1 {status} {REASONS.get(status, '')}\r\n"
+        f"Content-Type: {content_type}\r\n"
+        f"Content-Length: {len(data)}\r\n"
+        f"Connection: close\r\n\r\n".encode() + data
+    )
+    await writer.drain()
+
+
+async def stream(writer: asyncio.StreamWriter, chunks: typing.AsyncIterator[str]):
+    """send chunks as a chunked transfer encoded response. drain after
+    every chunk so a slow reader pauses its own session's generation
+    instead of growing our buffers"""
+    writer.write(
+        b"HTTP/1.1 200 OK\r\n"
+        b"Content-Type: text/plain; charset=utf-8\r\n"
+        b"Transfer-Encoding: chunked\r\n"
+        b"Connection: close\r\n\r\n"
+    )
+    async for chunk in chunks:
+        await write_chunk(writer, chunk)
+    await end_stream(writer)
+
+
+async def write_chunk(writer: asyncio.StreamWriter, chunk: str):
+    data = chunk.encode()
+    if data:
+        writer.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+        await writer.drain()
+
+
+async def end_stream(writer: asyncio.StreamWriter):
+    writer.write(b"0\r\n\r\n")
+    await writer.drain()
+
+
+class Server:
+    """routes requests to the sessions it hosts"""
+    root: str
+    make_chat: typing.Callable[[str], llm.StatefulChat]
+    sessions: dict[str, Session]
+
+    def __init__(self, root: str, make_chat: typing.Callable[[str], llm.StatefulChat]):
+        self.root = root
+        self.make_chat = make_chat
+        self.sessions = {}
+
+    async def create_session(self) -> Session:
+        session_id = uuid.uuid4().hex[:12]
+        workspace = os.path.join(self.root, session_id)
+        # starting a shell can take a while, don't stall other sessions
+        chat = await asyncio.to_thread(self._start, workspace)
+        session = Session(session_id, chat)
+        self.sessions[session_id] = session
+        return session
+
+    def _start(self, workspace: str) -> llm.StatefulChat:
+        shutil.copytree(TEMPLATE, workspace)
+        return self.make_chat(workspace)
+
+    async def close_session(self, session_id: str):
+        session = self.sessions.pop(session_id)
+        # don't wait for a turn in progress to finish on its own
+        session.interrupt()
+        async with session.lock:
+            await asyncio.to_thread(session.chat.close)
+
+    def session(self, session_id: str) -> Session:
+        try:
+            return self.sessions[session_id]
+        except KeyError:
+            raise HTTPError(404, f"no session {session_id}") from None
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        writer.transport.set_write_buffer_limits(high=WRITE_BUFFER_HIGH)
+        try:
+            request = await read_request(reader)
+            if request is not None:
+                await self.route(request, writer)
+        except HTTPError as exc:
+            await respond(writer, exc.status, {"error": str(exc)})
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def route(self, request: Request, writer: asyncio.StreamWriter):
+        parts = request.path.strip("/").split("/")
+        if parts == ["metrics"]:
+            await respond_text(writer, 200, metrics.REGISTRY.prometheus(), "text/plain; version=0.0.4")
+        elif parts == ["metrics.json"]:
+            await respond(writer, 200, metrics.REGISTRY.to_json())
+        elif parts == ["sessions"]:
+            if request.method != "POST":
+                raise HTTPError(405, "use POST to create a session")
+            session = await self.create_session()
+            await respond(writer, 200, {"id": session.id})
+        elif len(parts) == 2 and parts[0] == "sessions":
+            if request.method != "DELETE":
+                raise HTTPError(405, "use DELETE to close a session")
+            self.session(parts[1])
+            await self.close_session(parts[1])
+            await respond(writer, 200, {"closed": parts[1]})
+        elif len(parts) == 3 and parts[0] == "sessions" and parts[2] == "interrupt":
+            if request.method != "POST":
+                raise HTTPError(405, "use POST to interrupt a session")
+            session = self.session(parts[1])
+            await respond(writer, 200, {"interrupted": session.interrupt()})
+        elif len(parts) == 3 and parts[0] == "sessions" and parts[2] == "messages":
+            if request.method != "POST":
+                raise HTTPError(405, "use POST to send a message")
+            session = self.session(parts[1])
+            if session.lock.locked():
+                raise HTTPError(409, f"session {session.id} is already handling a message")
+            async with session.lock:
+                chunks = session.chat.interact(request.body.decode())
+                session.turn = asyncio.current_task()
+                session.interrupted = False
+                try:
+                    await stream(writer, chunks)
+                except asyncio.CancelledError:
+                    if not session.interrupted:
+                        raise
+                    # interrupted through the api, finish the response
+                    await write_chunk(writer, llm.INTERRUPTED + "\n")
+                    await end_stream(writer)
+                except ConnectionError:
+                    raise
+                except Exception as exc:
+                    # the 200 went out with the headers, so the error
+                    # can only be reported at the end of the body
+                    await write_chunk(writer, f"\n[failed: {exc}]\n")
+                    await end_stream(writer)
+                finally:
+                    session.turn = None
+                    # stop generating if the client went away mid response
+                    await chunks.aclose()
+        else:
+            raise HTTPError(404, f"no route for {request.path}")
+
+    async def close(self):
+        for session_id in list(self.sessions):
+            await self.close_session(session_id)
+
+
+async def serve(server: Server, host: str, port: int) -> asyncio.Server:
+    return await asyncio.start_server(server.handle, host, port)
+
+
+async def fetch(host: str, port: int, method: str, path: str, body: str = "") -> tuple[int, str]:
+    """a minimal client for this server: returns (status, body) with any
+    chunked encoding removed"""
+    reader, writer = await asyncio.open_connection(host, port)
+    data = body.encode()
+    writer.write(
+        f"{method} {path} HTTP/1.1\r\nHost: {host}\r\n"
+        f"Content-Length: {len(data)}\r\n\r\n".encode() + data
+    )
+    await writer.drain()
+    response = await reader.read()
+    writer.close()
+    head, _, payload = response.partition(b"\r\n\r\n")
+    status = int(head.split(b" ", 2)[1])
+    if b"transfer-encoding: chunked" in head.lower():
+        decoded = b""
+        while payload:
+            size, _, payload = payload.partition(b"\r\n")
+            size = int(size, 16)
+            decoded += payload[:size]
+            payload = payload[size + 2:]
+        payload = decoded
+    return status, payload.decode()
+
+
+async def main():
+    """main function"""
+    args = argparse.ArgumentParser()
+    args.add_argument("root", help="directory that holds one workspace per session")
+    args.add_argument("--prompt", default="consultant.prompt")
+    args.add_argument("--host", default="127.0.0.1")
+    args.add_argument("--port", type=int, default=8080)
+    args.add_argument("--model-requests", type=int, default=8,
+                      help="cap on model requests in flight across all sessions")
+    args.add_argument("--requests-per-minute", type=float,
+                      help="model request budget shared by all sessions")
+    args.add_argument("--tokens-per-minute", type=float,
+                      help="estimated input token budget shared by all sessions")
+    args.add_argument("--tool-timeout", type=float, default=300.0,
+                      help="seconds a shell command may run before it is interrupted")
+    args.add_argument("--turn-timeout", type=float,
+                      help="seconds a turn may take before it is stopped")
+    args.add_argument("--shell-commands", type=int, default=4,
+                      help="cap on shell commands running across all sessions")
+    args.add_argument("--metrics", action="store_true",
+                      help="record timing histograms and serve them on /metrics")
+    args.add_argument("--trace-dir", help="write a trace of every span to a file per session")
+    args = args.parse_args()
+
+    os.makedirs(args.root, exist_ok=True)
+    if args.trace_dir:
+        os.makedirs(args.trace_dir, exist_ok=True)
+    metrics.enable(args.metrics or bool(args.trace_dir))
+    system_prompt = open(args.prompt).read()
+    # the scheduler caps model requests, fairly across sessions
+    limits = llm.Limits.create(None, args.shell_commands)
+    shared = scheduler.Scheduler(
+        requests_per_minute=args.requests_per_minute,
+        tokens_per_minute=args.tokens_per_minute,
+        max_concurrent=args.model_requests,
+    )
+    dotenv.load_dotenv()
+    client = anthropic.AsyncAnthropic(api_key=os.environ["ANTHROPIC_API_KEY"], max_retries=0)
+    completions = backend.AnthropicBackend(client)
+
+    def make_chat(workspace: str) -> llm.StatefulChat:
+        session_id = os.path.basename(workspace)
+        trace = None
+        if args.trace_dir:
+            trace = os.path.join(args.trace_dir, session_id + ".jsonl")
+        return llm.StatefulChat(
+            system_prompt=system_prompt,
+            base_path=workspace,
+            completions=scheduler.ScheduledBackend(completions, shared, session_id),
+            limits=limits,
+            trace=trace,
+            tool_timeout=args.tool_timeout,
+            turn_timeout=args.turn_timeout,
+        )
+
+    server = Server(args.root, make_chat)
+    listener = await serve(server, args.host, args.port)
+    print(f"listening on {args.host}:{args.port}")
+    try:
+        async with listener:
+            await listener.serve_forever()
+    finally:
+        await server.close()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,47 @@
+import time
+
+import pytest
+
+from agent.backend import Exchange, RecordingBackend, ReplayBackend, ReplayExhausted, load_cassette, request_digest
+from agent.fakes import FakeBackend
+
+
+def conversation(prompt):
+    return [{"role": "user", "content": prompt}]
+
+
+async def collect(stream):
+    return [chunk async for chunk in stream]
+
+
+async def test_record_then_replay(tmp_path):
+    """a recorded session replays the same chunks with the same timing"""
+    path = str(tmp_path / "cassette.jsonl")
+    recorder = RecordingBackend(FakeBackend(lambda messages: "hello there world", delay=0.01), path)
+    assert await collect(recorder.stream(conversation("hi"), "system")) == ["hello ", "there ", "world"]
+    await collect(recorder.stream(conversation("bye"), "system"))
+
+    exchanges = load_cassette(path)
+    assert [exchange.prompt for exchange in exchanges] == ["hi", "bye"]
+    assert exchanges[0].digest == request_digest(conversation("hi"), "system")
+    assert all(delay >= 0.01 for delay, _ in exchanges[0].chunks)
+
+    replay = ReplayBackend.from_file(path, speed=1.0)
+    start = time.perf_counter()
+    assert await collect(replay.stream(conversation("hi"), "system")) == ["hello ", "there ", "world"]
+    assert time.perf_counter() - start >= 0.03
+
+
+async def test_replay_matching():
+    """identical requests find their exchange, anything else replays in order"""
+    exchanges = [
+        Exchange(request_digest(conversation("first"), ""), "first", [(1.0, "one")]),
+        Exchange(request_digest(conversation("second"), ""), "second", [(1.0, "two")]),
+        Exchange("unmatched", "third", [(1.0, "three")]),
+    ]
+    replay = ReplayBackend(exchanges, speed=None)
+    assert await collect(replay.stream(conversation("second"), "")) == ["two"]
+    assert await collect(replay.stream(conversation("changed"), "")) == ["one"]
+    assert await collect(replay.stream(conversation("changed"), "")) == ["three"]
+    with pytest.raises(ReplayExhausted):
+        await collect(replay.stream(conversation("more"), ""))
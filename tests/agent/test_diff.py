@@ -0,0 +1,74 @@
+import difflib
+import random
+
+from agent.diff import unified_diff
+
+
+def test_matches_difflib():
+    """small diffs are the same unified diff difflib would produce"""
+    before = "import os\n\ndef main():\n    print('hello')\n\nmain()\n"
+    after = "import os\nimport sys\n\ndef main():\n    print('hello', file=sys.stderr)\n\nmain()\n"
+    expected = difflib.unified_diff(
+        before.split("\n"), after.split("\n"), "before", "after", lineterm="",
+    )
+    assert unified_diff(before, after) == "\n".join(expected)
+
+
+def test_unchanged():
+    assert unified_diff("a\nb\n", "a\nb\n") == ""
+
+
+def test_large_change_is_summarized():
+    """changes too large to be worth reading become a summary"""
+    before = "\n".join(str(n) for n in range(5000))
+    after = "\n".join(str(n * 2) for n in range(5000))
+    assert unified_diff(before, after) == (
+        "changes span 4999 lines starting at line 2 (5000 lines before, "
+        "5000 after), too large to show as a diff"
+    )
+
+
+def test_small_change_in_large_file():
+    """a small edit in a huge file still gets a real diff"""
+    lines = [f"line {n}" for n in range(100000)]
+    before = "\n".join(lines)
+    lines[50000] = "changed"
+    after = "\n".join(lines)
+    assert unified_diff(before, after).split("\n") == [
+        "--- before",
+        "+++ after",
+        "@@ -49998,7 +49998,7 @@",
+        " line 49997",
+        " line 49998",
+        " line 49999",
+        "-line 50000",
+        "+changed",
+        " line 50001",
+        " line 50002",
+        " line 50003",
+    ]
+
+
+def test_repetitive_content_is_junked(monkeypatch):
+    """lines repeated thousands of times, as in generated json, are
+    treated as junk so the matcher stays close to linear in the changed
+    region instead of quadratic"""
+    matchers = []
+
+    class Recording(difflib.SequenceMatcher):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            matchers.append(self)
+
+    monkeypatch.setattr(difflib, "SequenceMatcher", Recording)
+    rng = random.Random(0)
+    choices = ["{", "}", '  "id": 1,', '  "name": "x",', "},"]
+    a = [rng.choice(choices) for _ in range(2000)]
+    b = list(a)
+    for _ in range(40):
+        b[rng.randrange(2000)] = rng.choice(choices)
+
+    ours = unified_diff("\n".join(a), "\n".join(b))
+    assert ours.startswith("--- before\n+++ after\n@@ ")
+    assert [matcher.bpopular for matcher in matchers] == [set(choices)]
+    assert ours.count("\n-") <= "\n".join(difflib.unified_diff(a, b, lineterm="")).count("\n-")
@@ -0,0 +1,161 @@
+import asyncio
+import os
+
+import pytest
+
+from agent import fakes, fanout, llm, shell
+
+
+class AnswerShell:
+    """tests pass when the workspace's src/answer.py returns 42"""
+
+    def __init__(self, workspace):
+        self.workspace = workspace
+        self.closed = False
+
+    def run(self, line, timeout=-1):
+        try:
+            with open(os.path.join(self.workspace, "src", "answer.py")) as file:
+                passed = "return 42" in file.read()
+        except FileNotFoundError:
+            passed = False
+        if passed:
+            return shell.ShellResponse("1 passed in 0.01s", 0)
+        return shell.ShellResponse("1 failed in 0.01s", 1)
+
+    def interrupt(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+
+def attempt(value):
+    """a model that writes src/answer.py returning value"""
+    def respond(messages):
+        if messages[-1]["content"] == "solve it":
+            return f'```python\ndef answer():\n    return {value}\n```\n{{"command": "write_file", "path": "src/answer.py"}}'
+        return "done"
+    return respond
+
+
+def make_chat(tmp_path):
+    workspace = tmp_path / "workspace"
+    (workspace / "src").mkdir(parents=True)
+    (workspace / "src" / "old.py").write_text("x = 1\n")
+    return llm.StatefulChat(
+        system_prompt="", base_path=str(workspace),
+        completions=fakes.FakeBackend(lambda messages: "hi"), sh=fakes.FakeShell(),
+    )
+
+
+def test_score():
+    green = shell.ShellResponse("12 passed in 0.5s", 0)
+    better = shell.ShellResponse("1 failed, 11 passed in 0.5s", 1)
+    worse = shell.ShellResponse("2 failed, 1 error, 10 passed in 0.5s", 1)
+    broken = shell.ShellResponse("no tests ran in 0.01s", 5)
+    assert sorted([broken, worse, green, better], key=fanout.score, reverse=True) == [green, better, worse, broken]
+
+
+async def test_best_branch_is_merged(tmp_path):
+    chat = make_chat(tmp_path)
+    backends = [fakes.FakeBackend(attempt(value)) for value in (41, 42, 43)]
+    branches = await fanout.fan_out(
+        chat, "solve it", branches=3,
+        make_completions=lambda number: backends[number],
+        make_shell=AnswerShell, stop_at_green=False,
+    )
+
+    assert [branch.passed for branch in branches] == [True, False, False]
+    assert branches[0].number == 1
+    assert (tmp_path / "workspace" / "src" / "answer.py").read_text() == "def answer():\n    return 42\n"
+    # the transcript is the winner's, pointing at our workspace
+    assert chat.chat.transcript[0]["content"] == "solve it"
+    assert chat.base_path in str(chat.chat.transcript[2]["content"])
+    assert "branch-1" not in str(chat.chat.transcript)
+    assert "src/answer.py:2:" in chat.search("return 42")
+    assert sorted(os.listdir(tmp_path)) == ["workspace"]
+
+    assert chat.turn == 1
+    chat.rewind(0)
+    assert not (tmp_path / "workspace" / "src" / "answer.py").exists()
+    assert chat.chat.transcript == []
+
+
+async def test_stops_at_first_green(tmp_path):
+    chat = make_chat(tmp_path)
+    backends = [fakes.FakeBackend(attempt(41), delay=1.0), fakes.FakeBackend(attempt(42))]
+    branches = await fanout.fan_out(
+        chat, "solve it", branches=2,
+        make_completions=lambda number: backends[number],
+        make_shell=AnswerShell,
+    )
+    assert [branch.number for branch in branches] == [1]
+    # the slow branch was cancelled part way through its first reply
+    assert len(backends[0].requests) == 1
+    assert backends[0].in_flight == 0
+    assert (tmp_path / "workspace" / "src" / "answer.py").exists()
+
+
+async def test_losing_branch_tests_are_interrupted(tmp_path):
+    """a branch still running its tests when another goes green has its
+    shell interrupted rather than left running"""
+    chat = make_chat(tmp_path)
+    backends = [fakes.FakeBackend(attempt(42), delay=0.02), fakes.FakeBackend(attempt(41))]
+    hung = fakes.FakeShell(hang={llm.TEST_COMMAND})
+    branches = await fanout.fan_out(
+        chat, "solve it", branches=2,
+        make_completions=lambda number: backends[number],
+        make_shell=lambda workspace: AnswerShell(workspace) if workspace.endswith("branch-0") else hung,
+    )
+    assert [branch.number for branch in branches] == [0]
+    assert hung.commands == [llm.TEST_COMMAND]
+    assert hung.interrupts == 1
+
+
+async def test_needs_a_branch(tmp_path):
+    with pytest.raises(ValueError):
+        await fanout.fan_out(make_chat(tmp_path), "solve it", branches=0)
+    assert sorted(os.listdir(tmp_path)) == ["workspace"]
+
+
+async def test_branch_that_fails_to_start(tmp_path):
+    """the branches that did start are closed and the error raised"""
+    chat = make_chat(tmp_path)
+    shells = []
+
+    def make_shell(workspace):
+        if workspace.endswith("branch-1"):
+            raise RuntimeError("the container didn't start")
+        shells.append(AnswerShell(workspace))
+        return shells[-1]
+
+    with pytest.raises(RuntimeError):
+        await fanout.fan_out(chat, "solve it", branches=3, make_shell=make_shell)
+    assert len(shells) == 2 and all(sh.closed for sh in shells)
+    assert sorted(os.listdir(tmp_path)) == ["workspace"]
+
+
+async def test_cancelled_fan_out_stops_its_branches(tmp_path):
+    """the branches stop before their shells are closed and their
+    workspaces removed"""
+    chat = make_chat(tmp_path)
+    backends = [fakes.FakeBackend(attempt(42), delay=0.05) for _ in range(2)]
+    shells = []
+
+    def make_shell(workspace):
+        shells.append(AnswerShell(workspace))
+        return shells[-1]
+
+    task = asyncio.ensure_future(fanout.fan_out(
+        chat, "solve it", branches=2,
+        make_completions=lambda number: backends[number], make_shell=make_shell,
+    ))
+    while not all(backend.in_flight for backend in backends):
+        await asyncio.sleep(0.01)
+    task.cancel()
+    await asyncio.gather(task, return_exceptions=True)
+    assert [backend.in_flight for backend in backends] == [0, 0]
+    assert all(sh.closed for sh in shells)
+    assert sorted(os.listdir(tmp_path)) == ["workspace"]
+    assert chat.turn == 0
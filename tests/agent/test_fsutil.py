@@ -0,0 +1,39 @@
+import os
+
+import pytest
+
+from agent.fsutil import atomic_replace, atomic_write, walk_files
+
+
+def test_atomic_write_keeps_mode(tmp_path):
+    """replacing a file keeps its permissions and leaves no temp files"""
+    path = os.path.join(tmp_path, "run.sh")
+    atomic_write(path, "echo one\n")
+    os.chmod(path, 0o755)
+    atomic_write(path, "echo two\n")
+    with open(path) as file:
+        assert file.read() == "echo two\n"
+    assert os.stat(path).st_mode & 0o777 == 0o755
+    assert os.listdir(tmp_path) == ["run.sh"]
+
+
+def test_atomic_replace_discards_on_error(tmp_path):
+    """a failed write leaves the original file untouched"""
+    path = os.path.join(tmp_path, "data.txt")
+    atomic_write(path, "original")
+    with pytest.raises(RuntimeError):
+        with atomic_replace(path) as tmp_path_:
+            with open(tmp_path_, "w") as file:
+                file.write("partial")
+            raise RuntimeError("interrupted")
+    with open(path) as file:
+        assert file.read() == "original"
+    assert os.listdir(tmp_path) == ["data.txt"]
+
+
+def test_walk_files_skips_hidden(tmp_path):
+    atomic_write(os.path.join(tmp_path, "a", "b.py"), "")
+    atomic_write(os.path.join(tmp_path, ".git", "c"), "")
+    atomic_write(os.path.join(tmp_path, "skip.json"), "")
+    paths = [path for path, _ in walk_files(str(tmp_path), ignore={"skip.json"})]
+    assert paths == [os.path.join("a", "b.py")]
@@ -0,0 +1,70 @@
+import os
+
+from agent.index import WorkspaceIndex, required_literals
+
+
+def write(root, path, content):
+    """write a file below root"""
+    path = os.path.join(root, path)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as file:
+        file.write(content)
+
+
+def test_required_literals():
+    """we can find the literal text any match of a regex must contain"""
+    assert required_literals(r"def\s+main") == ["def", "main"]
+    assert required_literals(r"(foo)+bar") == ["foo", "bar"]
+    assert required_literals(r"x?abc") == ["abc"]
+    assert required_literals(r"foo|bar") == []
+    assert required_literals(r"(") == []
+
+
+def test_search_kinds(tmp_path):
+    """text, regex and identifier searches report path:line hits"""
+    root = str(tmp_path)
+    write(root, "src/main.py", "import os\n\ndef main():\n    print(main_name)\n")
+    write(root, "src/other.py", "from main import main\n\nmain()\n")
+    index = WorkspaceIndex(root)
+    assert index.refresh() == 2
+
+    hits = index.search("print(")
+    assert [(hit.path, hit.line) for hit in hits] == [("src/main.py", 4)]
+    assert str(hits[0]) == "src/main.py-3- def main():\nsrc/main.py:4:     print(main_name)\n"
+
+    hits = index.search(r"def\s+ma", kind="regex")
+    assert [(hit.path, hit.line) for hit in hits] == [("src/main.py", 3)]
+
+    # definitions first, and main_name is not the identifier main
+    hits = index.search("main", kind="identifier")
+    assert [(hit.path, hit.line) for hit in hits] == [
+        ("src/main.py", 3),
+        ("src/other.py", 1),
+        ("src/other.py", 3),
+    ]
+
+
+def test_incremental_updates(tmp_path):
+    """the index tracks writes, stat changes and deletions"""
+    root = str(tmp_path)
+    write(root, "a.py", "alpha = 1\n")
+    write(root, "b.py", "beta = 2\n")
+    write(root, ".hidden/c.py", "alpha = 3\n")
+    write(root, "blob.bin", "alpha\0")
+    index = WorkspaceIndex(root)
+    index.refresh()
+    assert [hit.path for hit in index.search("alpha")] == ["a.py"]
+
+    # nothing changed so nothing is reindexed
+    assert index.refresh() == 0
+
+    write(root, "b.py", "beta = alpha\n")
+    index.update("b.py")
+    assert [hit.path for hit in index.search("alpha")] == ["a.py", "b.py"]
+
+    os.remove(os.path.join(root, "a.py"))
+    write(root, "d.py", "gamma = 4\n")
+    assert index.refresh() == 2
+    assert [hit.path for hit in index.search("alpha")] == ["b.py"]
+    assert [hit.path for hit in index.search("gamma")] == ["d.py"]
+    assert index.search("delta") == []
@@ -0,0 +1,191 @@
+import asyncio
+import os
+
+import pytest
+
+from agent import fakes, llm
+from tests import api_fakes
+
+
+def make_chat(tmp_path, respond, delay=0.0, **kwargs):
+    completions = fakes.FakeBackend(respond, delay=delay)
+    sh = fakes.FakeShell(hang={"poetry run pytest"})
+    chat = llm.StatefulChat(system_prompt="", base_path=str(tmp_path), completions=completions, sh=sh, **kwargs)
+    return chat, completions, sh
+
+
+async def collect(chunks):
+    return "".join([chunk async for chunk in chunks])
+
+
+def check_then_finish(messages):
+    if messages[-1]["content"] == "test it":
+        return '{"command": "check_tests"}'
+    return "done"
+
+
+async def test_cancel_during_stream(tmp_path):
+    """the partial reply is kept and the next turn works"""
+    chat, completions, _ = make_chat(tmp_path, lambda messages: "one two three four five six", delay=0.02)
+    turn = asyncio.ensure_future(collect(chat.interact("hi")))
+    await asyncio.sleep(0.05)
+    turn.cancel()
+    await asyncio.gather(turn, return_exceptions=True)
+
+    reply = chat.chat.transcript[-1]
+    assert reply["role"] == "assistant"
+    assert reply["content"].startswith("one ")
+    assert reply["content"].endswith(llm.INTERRUPTED)
+    assert completions.in_flight == 0
+
+    assert await collect(chat.interact("again")) == "one two three four five six\n"
+    assert [message["role"] for message in chat.chat.transcript] == ["user", "assistant"] * 2
+
+
+async def test_closing_keeps_partial_reply(tmp_path):
+    chat, _, _ = make_chat(tmp_path, lambda messages: "one two three")
+    chunks = chat.interact("hi")
+    assert await anext(chunks) == "one "
+    await chunks.aclose()
+    assert chat.chat.transcript[-1]["content"] == "one " + llm.INTERRUPTED
+
+
+async def test_failed_request_keeps_alternating(tmp_path):
+    """an error from the model is raised, the reply so far is kept and
+    the next turn works"""
+    chat, _, _ = make_chat(tmp_path, lambda messages: "one two three")
+    chat.chat.backend = api_fakes.FlakyBackend(chat.chat.backend, [(400, 2)])
+    with pytest.raises(api_fakes.FakeAPIError):
+        await collect(chat.interact("hi"))
+    assert chat.chat.transcript[-1]["content"] == "one two " + llm.FAILED
+
+    assert await collect(chat.interact("again")) == "one two three\n"
+    assert [message["role"] for message in chat.chat.transcript] == ["user", "assistant"] * 2
+
+
+async def test_cancel_interrupts_running_tool(tmp_path):
+    """a hung command is interrupted and its followup never sent"""
+    chat, completions, sh = make_chat(tmp_path, check_then_finish)
+    turn = asyncio.ensure_future(collect(chat.interact("test it")))
+    while not sh.commands:
+        await asyncio.sleep(0.01)
+    turn.cancel()
+    await asyncio.gather(turn, return_exceptions=True)
+
+    assert sh.interrupts == 1
+    assert len(completions.requests) == 1
+    assert "skipped check_tests, the turn was interrupted" in chat.evaluate_tools('{"command": "check_tests"}')[0]["text"]
+    assert await collect(chat.interact("hello")) == "done\n"
+
+
+async def test_tool_timeout(tmp_path):
+    chat, completions, _ = make_chat(tmp_path, check_then_finish, tool_timeout=0.05)
+    assert await collect(chat.interact("test it")) == '{"command": "check_tests"}\ndone\n'
+    assert "interrupted after 0.05 seconds" in completions.requests[1][-1]["content"]
+
+
+async def test_turn_deadline(tmp_path):
+    """a turn past its deadline stops streaming and reports why"""
+    chat, _, _ = make_chat(tmp_path, lambda messages: " ".join(["word"] * 100), delay=0.01, turn_timeout=0.1)
+    output = await collect(chat.interact("hi"))
+    assert output.endswith("[stopped, the turn took longer than 0.1 seconds]\n")
+    assert chat.chat.transcript[-1]["content"].endswith(llm.INTERRUPTED)
+    assert chat.turn == 1
+
+
+async def test_turn_deadline_bounds_tools(tmp_path):
+    """a hung tool only gets what is left of the turn"""
+    chat, completions, _ = make_chat(tmp_path, check_then_finish, turn_timeout=0.1)
+    output = await collect(chat.interact("test it"))
+    assert output.endswith("[stopped, the turn took longer than 0.1 seconds]\n")
+    assert len(completions.requests) == 1
+    assert "invoked check_tests" in str(chat.chat.transcript[-2]["content"])
+
+
+async def test_interrupt_keeps_tool_output(tmp_path):
+    """interrupt() stops the turn as an interrupt, not a deadline, and
+    the output of the tools that ran reaches the model next turn"""
+    def respond(messages):
+        if messages[-1]["content"] == "test it":
+            return '{"command": "check_tests"}\n{"command": "ls_tree"}'
+        return "done"
+
+    chat, completions, sh = make_chat(tmp_path, respond)
+    turn = asyncio.ensure_future(collect(chat.interact("test it")))
+    while not sh.commands:
+        await asyncio.sleep(0.01)
+    chat.interrupt()
+    output = await turn
+    assert output.endswith(llm.INTERRUPTED + "\n")
+    assert "took longer" not in output
+    assert len(completions.requests) == 1
+
+    assert await collect(chat.interact("hello")) == "done\n"
+    sent = completions.requests[1]
+    assert [message["role"] for message in sent] == ["user", "assistant", "user", "assistant", "user"]
+    assert "invoked check_tests" in sent[2]["content"]
+    assert "skipped ls_tree, the turn was interrupted" in sent[2]["content"]
+
+
+async def test_streamed_write(tmp_path):
+    """a block followed by write_file is moved into place, others are discarded"""
+    def respond(messages):
+        if messages[-1]["content"] == "write it":
+            return '```python\nx = 1\n```\n{"command": "write_file", "path": "src/x.py"}\n```\nscratch\n```'
+        return "done"
+
+    chat, completions, _ = make_chat(tmp_path, respond)
+    await collect(chat.interact("write it"))
+    assert (tmp_path / "src" / "x.py").read_text() == "x = 1\n"
+    assert "created" in completions.requests[1][-1]["content"]
+    assert os.listdir(tmp_path / llm.STAGING_DIR) == []
+    assert chat.search("x = 1").startswith("src/x.py:1:")
+
+
+def test_search_tool(tmp_path):
+    """the model's numbers parse as floats, search still takes them"""
+    (tmp_path / "a.py").write_text("one\ntwo\nthree\nfour\nfive\n")
+    chat, _, _ = make_chat(tmp_path, lambda messages: "")
+    observed = chat.evaluate_tools('{"command": "search", "pattern": "three", "context": 2}')
+    text = "".join(part["text"] for part in observed if part["type"] == "text")
+    assert "failed" not in text
+    assert "a.py-1- one" in text and "a.py:3: three" in text and "a.py-5- five" in text
+
+
+def test_search_context_is_capped(tmp_path):
+    (tmp_path / "a.py").write_text("".join(f"line {n}\n" for n in range(100)))
+    chat, _, _ = make_chat(tmp_path, lambda messages: "")
+    found = chat.search("line 50", context=1000)
+    assert len(found.splitlines()) == 2 * llm.MAX_SEARCH_CONTEXT + 1
+
+
+async def test_written_content_is_saved_once(tmp_path):
+    """the model's code block is the only copy of a file it wrote that
+    the saved transcript keeps"""
+    body = "".join(f"value_{n} = {n}\n" for n in range(500))
+
+    def respond(messages):
+        if messages[-1]["content"] == "write it":
+            return f'```python\n{body}```\n{{"command": "write_file", "path": "big.py"}}'
+        return "done"
+
+    chat, _, _ = make_chat(tmp_path, respond)
+    await collect(chat.interact("write it"))
+    saved = (tmp_path / "transcript.json").read_text()
+    assert saved.count("value_499 = 499") == 1
+
+
+async def test_command_waiting_for_a_slot_is_dropped(tmp_path):
+    """a turn cancelled while its command waits for a shell slot never
+    runs that command"""
+    chat, _, sh = make_chat(tmp_path, check_then_finish, limits=llm.Limits.create(shell_commands=1))
+    chat.limits.shell_commands.acquire()
+    turn = asyncio.ensure_future(collect(chat.interact("test it")))
+    while not chat.chat.transcript or chat.chat.transcript[-1]["role"] != "assistant":
+        await asyncio.sleep(0.01)
+    await asyncio.sleep(0.05)
+    turn.cancel()
+    await asyncio.gather(turn, return_exceptions=True)
+    chat.limits.shell_commands.release()
+    await asyncio.sleep(2 * llm.SLOT_POLL_SECONDS)
+    assert sh.commands == []
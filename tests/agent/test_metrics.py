@@ -0,0 +1,83 @@
+import json
+import os
+import shutil
+
+import pytest
+
+from agent import fakes, llm, metrics
+
+
+TEMPLATE = os.path.join(os.path.dirname(__file__), "..", "..", "isolation_env", "python", "template")
+
+
+@pytest.fixture
+def registry():
+    """the global registry, enabled for the test and reset after"""
+    metrics.enable()
+    yield metrics.REGISTRY
+    metrics.enable(False)
+    metrics.REGISTRY.reset()
+
+
+def test_disabled_records_nothing():
+    registry = metrics.Registry()
+    span = registry.span("work")
+    assert span is metrics.NULL_SPAN
+    with span:
+        pass
+    registry.observe("size_bytes", 10)
+    assert registry.to_json() == []
+
+
+def test_prometheus_text():
+    """histograms render in the prometheus exposition format"""
+    registry = metrics.Registry(enabled=True)
+    registry.observe("tool_call_seconds", 0.003, tool="ls_tree")
+    registry.observe("tool_call_seconds", 0.2, tool="ls_tree")
+    registry.observe("shell_output_bytes", 50)
+    lines = registry.prometheus().split("\n")
+    assert "# TYPE agent_tool_call_seconds histogram" in lines
+    assert 'agent_tool_call_seconds_bucket{tool="ls_tree",le="0.005"} 1' in lines
+    assert 'agent_tool_call_seconds_bucket{tool="ls_tree",le="0.25"} 2' in lines
+    assert 'agent_tool_call_seconds_bucket{tool="ls_tree",le="+Inf"} 2' in lines
+    assert 'agent_tool_call_seconds_count{tool="ls_tree"} 2' in lines
+    assert 'agent_shell_output_bytes_bucket{le="100"} 1' in lines
+    assert "agent_shell_output_bytes_sum 50.0" in lines
+
+
+async def test_turn_is_instrumented(tmp_path, registry):
+    """a turn records model, tool, shell and persistence timings and
+    writes them to the session's trace"""
+    workspace = str(tmp_path / "workspace")
+    shutil.copytree(TEMPLATE, workspace)
+
+    def respond(messages):
+        if len(messages) == 1:
+            return '{"command": "check_tests"}'
+        return "all good"
+
+    trace_path = str(tmp_path / "trace.jsonl")
+    chat = llm.StatefulChat("", workspace, completions=fakes.FakeBackend(respond),
+                            sh=fakes.FakeShell(), trace=trace_path)
+    async for _ in chat.interact("test please"):
+        pass
+    chat.close()
+
+    names = {(entry["name"], tuple(entry["labels"].items())) for entry in registry.to_json()}
+    assert names >= {
+        ("model_queue_wait_seconds", ()),
+        ("model_request_seconds", ()),
+        ("model_time_to_first_token_seconds", ()),
+        ("model_chunks_per_second", ()),
+        ("tool_call_seconds", (("tool", "check_tests"),)),
+        ("shell_queue_wait_seconds", ()),
+        ("transcript_save_seconds", ()),
+        ("snapshot_seconds", ()),
+        ("turn_seconds", ()),
+    }
+    with open(trace_path) as file:
+        records = [json.loads(line) for line in file]
+    assert {"span": "tool_call", "tool": "check_tests"}.items() <= next(
+        record for record in records if record.get("span") == "tool_call"
+    ).items()
+    assert any(record.get("metric") == "turn_seconds" for record in records)
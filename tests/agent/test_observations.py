@@ -0,0 +1,40 @@
+from agent.observations import BlobStore, merge, render, text
+
+
+def test_render_plain_strings():
+    """string content passes through untouched"""
+    messages = [{"role": "user", "content": "hi"}, {"role": "assistant", "content": "hello"}]
+    assert render(messages, BlobStore()) == messages
+
+
+def test_only_latest_copy_is_rendered():
+    """earlier copies of a file become short notes"""
+    blobs = BlobStore()
+    messages = [
+        {"role": "user", "content": [text("a: "), blobs.file("src/a.py", "x = 1\n")]},
+        {"role": "assistant", "content": "ok"},
+        {"role": "user", "content": [text("again: "), blobs.file("./src/a.py", "x = 1\n")]},
+        {"role": "assistant", "content": "ok"},
+        {"role": "user", "content": [text("b: "), blobs.file("src/b.py", "y = 1\n")]},
+        {"role": "assistant", "content": "ok"},
+        {"role": "user", "content": [text("wrote b"), blobs.changed("src/b.py", "digest of y = 2")]},
+    ]
+    assert [message["content"] for message in render(messages, blobs)] == [
+        "a: [content of src/a.py omitted, it is identical to a later copy in this conversation]",
+        "ok",
+        "again: x = 1\n",
+        "ok",
+        "b: [content of src/b.py omitted, it is outdated by a later version in this conversation]",
+        "ok",
+        "wrote b",
+    ]
+    # identical content is only held once, and written content not at all
+    assert len(blobs.blobs) == 2
+    assert len(blobs.referenced(messages[:4])) == 1
+    assert len(blobs.referenced(messages)) == 2
+
+
+def test_merge():
+    blobs = BlobStore()
+    file = blobs.file("a.py", "")
+    assert merge([text("a"), text("b"), file, text("c")]) == [text("ab"), file, text("c")]
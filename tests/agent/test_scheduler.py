@@ -0,0 +1,207 @@
+import asyncio
+
+import anthropic
+import pytest
+
+from agent.backend import AnthropicBackend, RecordingBackend, load_cassette
+from agent.fakes import FakeBackend
+from agent.scheduler import Budget, ScheduledBackend, Scheduler, estimate_tokens, is_transient, retry_after
+from tests.api_fakes import FakeAPIError, FakeAPIServer, FlakyBackend, Reply
+
+
+REPLY = "the quick brown fox jumps over the lazy dog"
+
+
+def conversation(prompt):
+    return [{"role": "user", "content": prompt}]
+
+
+def continuing(messages):
+    """answers a prefilled request with the rest of REPLY"""
+    if messages[-1]["role"] == "assistant":
+        return REPLY[len(messages[-1]["content"]):].lstrip(" ")
+    return REPLY
+
+
+async def collect(stream):
+    return [chunk async for chunk in stream]
+
+
+def fast_scheduler(**kwargs):
+    return Scheduler(base_delay=0.001, max_delay=0.01, **kwargs)
+
+
+def test_transient_errors():
+    assert is_transient(FakeAPIError(429))
+    assert is_transient(FakeAPIError(529))
+    assert not is_transient(FakeAPIError(400))
+    assert not is_transient(ValueError())
+    assert retry_after(FakeAPIError(429, retry_after=2)) == 2.0
+    assert retry_after(FakeAPIError(429)) is None
+
+
+def api_backend(api):
+    return AnthropicBackend(anthropic.AsyncAnthropic(api_key="test", base_url=api.url, max_retries=0), model="fake")
+
+
+async def test_api_errors():
+    """the client's own errors: rejected requests, error events part way
+    through a stream, which arrive with status 200, and dropped connections"""
+    async def failure(reply):
+        async with FakeAPIServer([reply]) as api:
+            with pytest.raises(Exception) as raised:
+                await collect(api_backend(api).stream(conversation("hi"), ""))
+            return raised.value
+
+    assert is_transient(await failure(Reply(status=429, error="rate_limit_error")))
+    assert is_transient(await failure(Reply(status=529, error="overloaded_error")))
+    assert not is_transient(await failure(Reply(status=400, error="invalid_request_error")))
+    assert is_transient(await failure(Reply(["the "], error="overloaded_error")))
+    assert is_transient(await failure(Reply(["the "], error="api_error")))
+    assert not is_transient(await failure(Reply(["the "], error="invalid_request_error")))
+    assert is_transient(await failure(Reply(["the "], drop=True)))
+
+
+async def test_retries_api_errors():
+    """rejections, error events and dropped connections are retried and
+    the reply continued from where each broke off"""
+    replies = [
+        Reply(status=429, error="rate_limit_error", retry_after=0),
+        Reply(status=529, error="overloaded_error"),
+        Reply(["the ", "quick "], error="overloaded_error"),
+        Reply([" brown ", "fox "], drop=True),
+        Reply([" jumps over the lazy dog"]),
+    ]
+    async with FakeAPIServer(replies) as api:
+        scheduled = ScheduledBackend(api_backend(api), fast_scheduler(), "a")
+        assert "".join(await collect(scheduled.stream(conversation("hi"), ""))) == REPLY
+    assert len(api.requests) == 5
+    assert api.requests[3]["messages"][-1] == {"role": "assistant", "content": "the quick"}
+    assert api.requests[4]["messages"][-1] == {"role": "assistant", "content": "the quick brown fox"}
+
+
+def test_budget_refills():
+    now = [0.0]
+    budget = Budget(60, lambda: now[0])
+    assert budget.wait(60) == 0
+    budget.take(60)
+    assert budget.wait(1) == pytest.approx(1.0)
+    now[0] = 0.5
+    assert budget.wait(1) == pytest.approx(0.5)
+    now[0] = 120
+    assert budget.wait(1000) == 0
+    assert Budget(None, lambda: 0).wait(10 ** 9) == 0
+
+
+async def test_retries_before_streaming():
+    """a request rejected outright is sent again"""
+    fake = FakeBackend(lambda messages: REPLY)
+    scheduled = ScheduledBackend(FlakyBackend(fake, [(429, 0), (529, 0)]), fast_scheduler(), "a")
+    assert "".join(await collect(scheduled.stream(conversation("hi"), ""))) == REPLY
+    assert len(fake.requests) == 3
+
+
+async def test_resumes_a_broken_stream():
+    """a stream that fails part way continues from what was already sent
+    rather than starting over"""
+    fake = FakeBackend(continuing)
+    scheduled = ScheduledBackend(FlakyBackend(fake, [(529, 3)]), fast_scheduler(), "a")
+    chunks = await collect(scheduled.stream(conversation("hi"), ""))
+    assert "".join(chunks) == REPLY
+    assert fake.requests[1][-1] == {"role": "assistant", "content": "the quick brown"}
+    assert fake.requests[1][:-1] == conversation("hi")
+
+
+async def test_gives_up():
+    fake = FakeBackend(lambda messages: REPLY)
+    scheduled = ScheduledBackend(FlakyBackend(fake, [(400, 0)]), fast_scheduler(), "a")
+    with pytest.raises(FakeAPIError):
+        await collect(scheduled.stream(conversation("hi"), ""))
+    assert len(fake.requests) == 1
+
+    scheduled = ScheduledBackend(FlakyBackend(fake, [(529, 0)] * 3), fast_scheduler(max_retries=2), "a")
+    with pytest.raises(FakeAPIError):
+        await collect(scheduled.stream(conversation("hi"), ""))
+
+
+async def test_rate_limit_pauses_every_session():
+    """retry-after is honoured, and by the other sessions too"""
+    scheduler = fast_scheduler()
+    loop = asyncio.get_running_loop()
+    flaky = ScheduledBackend(FlakyBackend(FakeBackend(lambda m: "one"), [(429, 0)], retry_after=0.2), scheduler, "a")
+    other = ScheduledBackend(FakeBackend(lambda m: "two"), scheduler, "b")
+
+    start = loop.time()
+    first = asyncio.create_task(collect(flaky.stream(conversation("hi"), "")))
+    await asyncio.sleep(0.05)
+    await collect(other.stream(conversation("hi"), ""))
+    assert loop.time() - start >= 0.19
+    assert await first == ["one"]
+
+
+async def test_requests_per_minute():
+    scheduler = fast_scheduler(requests_per_minute=600)
+    scheduler.requests.available = 1
+    scheduled = ScheduledBackend(FakeBackend(lambda m: "ok"), scheduler, "a")
+    loop = asyncio.get_running_loop()
+    start = loop.time()
+    await asyncio.gather(*(collect(scheduled.stream(conversation("hi"), "")) for _ in range(3)))
+    # one request up front, then one every tenth of a second
+    assert loop.time() - start >= 0.19
+
+
+async def test_tokens_per_minute():
+    scheduler = fast_scheduler(tokens_per_minute=6000)
+    scheduler.tokens.available = 0
+    scheduled = ScheduledBackend(FakeBackend(lambda m: "ok"), scheduler, "a")
+    messages = conversation("x" * 40)
+    loop = asyncio.get_running_loop()
+    start = loop.time()
+    await collect(scheduled.stream(messages, ""))
+    assert loop.time() - start >= estimate_tokens(messages, "") / 100 - 0.01
+
+
+async def test_concurrency_and_fairness():
+    """a session with many queued requests doesn't hold up the others"""
+    fake = FakeBackend(lambda m: "a b", delay=0.01)
+    scheduler = fast_scheduler(max_concurrent=2)
+    order = []
+
+    async def send(session, n):
+        await collect(ScheduledBackend(fake, scheduler, session).stream(conversation(f"{session}{n}"), ""))
+        order.append(session)
+
+    tasks = [send("busy", n) for n in range(6)] + [send("quiet", 0)]
+    await asyncio.gather(*tasks)
+    assert fake.peak_in_flight == 2
+    # two run straight away, then the sessions take turns. first come
+    # first served would have finished quiet last
+    assert order.index("quiet") == 3
+
+
+async def test_cancelled_waiter_leaves_the_queue():
+    fake = FakeBackend(lambda m: "a b", delay=0.05)
+    scheduler = fast_scheduler(max_concurrent=1)
+    running = asyncio.create_task(collect(ScheduledBackend(fake, scheduler, "a").stream(conversation("1"), "")))
+    await asyncio.sleep(0)
+    waiting = asyncio.create_task(collect(ScheduledBackend(fake, scheduler, "b").stream(conversation("2"), "")))
+    await asyncio.sleep(0.01)
+    waiting.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await waiting
+    assert "b" not in scheduler.queues
+    await running
+    assert scheduler.in_flight == 0
+
+
+async def test_recording_leaves_out_backoff(tmp_path):
+    """a cassette recorded through the scheduler times the model, not the
+    retry it had to wait for"""
+    path = str(tmp_path / "cassette.jsonl")
+    flaky = FlakyBackend(FakeBackend(lambda messages: REPLY), [(429, 0)], retry_after=1.0)
+    scheduled = ScheduledBackend(flaky, fast_scheduler(), "a")
+    recorder = RecordingBackend(scheduled, path)
+    assert "".join(await collect(recorder.stream(conversation("hi"), ""))) == REPLY
+    assert scheduled.waited >= 1.0
+    [exchange] = load_cassette(path)
+    assert sum(delay for delay, _ in exchange.chunks) < 1.0
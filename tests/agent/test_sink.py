@@ -0,0 +1,63 @@
+import os
+
+from agent.detector import CodeBlock, JSONMDParser
+from agent.sink import BlockSink, StagedBlock
+
+
+REPLY = (
+    'Here is the module.\n#### src/main.py\n```python\ndef main():\n    return "``"\n```\n'
+    '{"command": "write_file", "path": "src/main.py"}\n'
+    '```json\n{"command": "check_tests"}\n```\n'
+    'and a stray block\n```\nnot written\n```\ndone {"command": "ls_tree"}'
+)
+
+
+def staged_text(element):
+    if isinstance(element, StagedBlock):
+        with open(element.path) as file:
+            return ("block", element.language, file.read())
+    if isinstance(element, CodeBlock):
+        return ("block", element.language, element.code)
+    return element
+
+
+def feed(sink, text, size):
+    elements = []
+    for start in range(0, len(text), size):
+        elements += sink.feed(text[start:start + size])
+    return elements + sink.close()
+
+
+def test_matches_the_parser(tmp_path):
+    """any chunking gives the same elements as scanning the whole reply"""
+    expected = [staged_text(element) for element in JSONMDParser().scan(REPLY)]
+    for size in (1, 2, 3, 7, 64, len(REPLY)):
+        sink = BlockSink(str(tmp_path / str(size)))
+        assert [staged_text(element) for element in feed(sink, REPLY, size)] == expected
+        sink.discard()
+        assert os.listdir(tmp_path / str(size)) == []
+
+
+def test_streams_to_disk(tmp_path):
+    sink = BlockSink(str(tmp_path))
+    assert sink.feed("#### a.py\n```python\n" + "x = 1\n" * 100) == []
+    sink.file.flush()
+    assert os.path.getsize(sink.block.path) > 0
+    block, = sink.feed("```")
+    assert block.heading == "#### a.py"
+    assert block.size == 600
+
+
+def test_unterminated_block_is_dropped(tmp_path):
+    sink = BlockSink(str(tmp_path))
+    assert feed(sink, '```python\nprint(1)\n{"command": "ls_tree"}', 5) == []
+    sink.discard()
+    assert os.listdir(tmp_path) == []
+
+
+def test_append(tmp_path):
+    sink = BlockSink(str(tmp_path))
+    first, second = feed(sink, "```\none\n```\n```\ntwo\n```", 4)
+    first.append(second)
+    assert staged_text(first) == ("block", None, "one\ntwo\n")
+    assert not os.path.exists(second.path)
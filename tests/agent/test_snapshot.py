@@ -0,0 +1,100 @@
+import os
+import shutil
+
+import pytest
+
+from agent.snapshot import SnapshotStore
+
+
+def write(root, path, content):
+    """write a file below root"""
+    path = os.path.join(root, path)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as file:
+        file.write(content)
+
+
+def read(root, path):
+    with open(os.path.join(root, path)) as file:
+        return file.read()
+
+
+def count_blobs(root):
+    return sum(len(files) for _, _, files in os.walk(os.path.join(root, ".snapshots", "objects")))
+
+
+def test_snapshot_and_rollback(tmp_path):
+    """rolling back restores changed, deleted and created files"""
+    root = str(tmp_path)
+    write(root, "src/a.py", "a = 1\n")
+    write(root, "src/b.py", "b = 1\n")
+    store = SnapshotStore(root)
+    store.snapshot(0, transcript_length=0)
+
+    write(root, "src/a.py", "a = 2\n")
+    os.remove(os.path.join(root, "src/b.py"))
+    write(root, "src/c.py", "c = 1\n")
+    store.snapshot(1, transcript_length=2)
+    assert store.turns() == [0, 1]
+
+    assert store.rollback(0) == ["src/a.py", "src/b.py", "src/c.py"]
+    assert read(root, "src/a.py") == "a = 1\n"
+    assert read(root, "src/b.py") == "b = 1\n"
+    assert not os.path.exists(os.path.join(root, "src/c.py"))
+    assert store.turns() == [0]
+    assert store.load(0).meta == {"transcript_length": 0}
+
+    # nothing changed since the rollback so there is nothing to restore
+    assert store.rollback(0) == []
+
+    # the blobs only used by the discarded turn went with it
+    assert count_blobs(root) == 2
+    assert store.prune() == 0
+    with pytest.raises(ValueError):
+        store.load(1)
+
+
+def test_rollback_between_file_and_directory(tmp_path):
+    """a file can come back where a directory was, and the other way round"""
+    root = str(tmp_path)
+    write(root, "a", "a file\n")
+    store = SnapshotStore(root)
+    store.snapshot(0)
+    os.remove(os.path.join(root, "a"))
+    write(root, "a/b.py", "b = 1\n")
+    store.snapshot(1)
+
+    assert store.rollback(0) == ["a", "a/b.py"]
+    assert read(root, "a") == "a file\n"
+    assert store.turns() == [0]
+
+    os.remove(os.path.join(root, "a"))
+    write(root, "a/b/c.py", "c = 1\n")
+    store.snapshot(1)
+    shutil.rmtree(os.path.join(root, "a"))
+    write(root, "a", "a file again\n")
+    store.snapshot(2)
+    assert store.rollback(1) == ["a", "a/b/c.py"]
+    assert read(root, "a/b/c.py") == "c = 1\n"
+
+
+def test_snapshots_deduplicate(tmp_path):
+    """unchanged and duplicated content is only stored once"""
+    root = str(tmp_path)
+    for n in range(10):
+        write(root, f"file{n}.txt", "same\n")
+    write(root, "transcript.json", "[]")
+    store = SnapshotStore(root, ignore={"transcript.json"})
+    store.snapshot(0)
+    store.snapshot(1)
+    assert count_blobs(root) == 1
+    assert "transcript.json" not in store.load(1).files
+
+    # a new store picks up where the last one left off
+    write(root, "file0.txt", "different\n")
+    store = SnapshotStore(root, ignore={"transcript.json"})
+    store.snapshot(2)
+    assert count_blobs(root) == 2
+    store.rollback(1)
+    assert read(root, "file0.txt") == "same\n"
+    assert count_blobs(root) == 1
@@ -0,0 +1,141 @@
+"""failing stand-ins for the model api: an error as the anthropic
+client raises it, a backend that fails its first requests, and a local
+http server speaking the messages api for the real client to talk to"""
+
+import asyncio
+import dataclasses
+import json
+import types
+import typing
+
+
+class FakeAPIError(Exception):
+    """an api error as the anthropic client raises them: a status_code and
+    a response whose headers may carry retry-after"""
+    status_code: int
+    response: types.SimpleNamespace
+
+    def __init__(self, status_code: int, retry_after: float|None = None):
+        super().__init__(f"status {status_code}")
+        self.status_code = status_code
+        headers = {} if retry_after is None else {"retry-after": str(retry_after)}
+        self.response = types.SimpleNamespace(headers=headers)
+
+
+class FlakyBackend:
+    """wraps another backend and fails the first requests with the errors
+    in failures, each raised after that many chunks have been streamed,
+    given as (status_code, chunks) pairs"""
+    backend: typing.Any
+    failures: list[tuple[int, int]]
+    retry_after: float|None
+
+    def __init__(self, backend, failures: list[tuple[int, int]], retry_after: float|None = None):
+        self.backend = backend
+        self.failures = list(failures)
+        self.retry_after = retry_after
+
+    async def stream(self, messages: list[dict], system: str) -> typing.AsyncIterator[str]:
+        failure = self.failures.pop(0) if self.failures else None
+        sent = 0
+        async for text in self.backend.stream(messages, system):
+            if failure is not None and sent == failure[1]:
+                raise FakeAPIError(failure[0], self.retry_after)
+            sent += 1
+            yield text
+        if failure is not None:
+            raise FakeAPIError(failure[0], self.retry_after)
+
+
+@dataclasses.dataclass
+class Reply:
+    """how FakeAPIServer answers one request. a status other than 200
+    rejects it with error as the error body's type. otherwise chunks are
+    streamed as text deltas and the stream then ends, fails with an
+    error event of type error, or with drop the connection is cut"""
+    chunks: list[str] = dataclasses.field(default_factory=list)
+    status: int = 200
+    error: str|None = None
+    drop: bool = False
+    retry_after: float|None = None
+
+
+class FakeAPIServer:
+    """a local stand-in for the anthropic messages api, so the real client
+    turns its responses into exceptions. answers each request with the
+    next of replies and keeps the request bodies in requests"""
+    replies: list[Reply]
+    requests: list[dict]
+    server: asyncio.Server|None
+
+    def __init__(self, replies: list[Reply]):
+        self.replies = list(replies)
+        self.requests = []
+        self.server = None
+
+    @property
+    def url(self) -> str:
+        host, port = self.server.sockets[0].getsockname()[:2]
+        return f"http://{host}:{port}"
+
+    async def __aenter__(self) -> "FakeAPIServer":
+        self.server = await asyncio.start_server(self.handle, "127.0.0.1", 0)
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.server.close()
+        await self.server.wait_closed()
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            await reader.readline()
+            length = 0
+            while (line := await reader.readline()) not in (b"\r\n", b""):
+                name, _, value = line.decode().partition(":")
+                if name.strip().lower() == "content-length":
+                    length = int(value)
+            self.requests.append(json.loads(await reader.readexactly(length)))
+            reply = self.replies.pop(0)
+            headers = "Connection: close\r\n"
+            if reply.retry_after is not None:
+                headers += f"Retry-After: {reply.retry_after}\r\n"
+            if reply.status != 200:
+                body = json.dumps({"type": "error", "error": {"type": reply.error, "message": reply.error}}).encode()
+                writer.write(
+                    f"HTTP/1.1 {reply.status} Error\r\n{headers}Content-Type: application/json\r\n"
+                    f"Content-Length: {len(body)}\r\n\r\n".encode() + body
+                )
+                return
+            writer.write(
+                f"HTTP/1.1 200 OK\r\n{headers}Content-Type: text/event-stream\r\n"
+                f"Transfer-Encoding: chunked\r\n\r\n".encode()
+            )
+            events = [
+                ("message_start", {"message": {
+                    "id": "msg_fake", "type": "message", "role": "assistant", "model": "fake",
+                    "content": [], "stop_reason": None, "stop_sequence": None,
+                    "usage": {"input_tokens": 1, "output_tokens": 0},
+                }}),
+                ("content_block_start", {"index": 0, "content_block": {"type": "text", "text": ""}}),
+            ] + [
+                ("content_block_delta", {"index": 0, "delta": {"type": "text_delta", "text": chunk}})
+                for chunk in reply.chunks
+            ]
+            if reply.error is not None:
+                events.append(("error", {"error": {"type": reply.error, "message": reply.error}}))
+            elif not reply.drop:
+                events += [
+                    ("content_block_stop", {"index": 0}),
+                    ("message_delta", {"delta": {"stop_reason": "end_turn", "stop_sequence": None},
+                                       "usage": {"output_tokens": len(reply.chunks)}}),
+                    ("message_stop", {}),
+                ]
+            for event, data in events:
+                frame = f"event: {event}\ndata: {json.dumps({'type': event, **data})}\n\n".encode()
+                writer.write(f"{len(frame):x}\r\n".encode() + frame + b"\r\n")
+                await writer.drain()
+            if not reply.drop:
+                writer.write(b"0\r\n\r\n")
+        finally:
+            await writer.drain()
+            writer.close()
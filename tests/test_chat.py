@@ -0,0 +1,21 @@
+import os
+
+import chat
+from agent import fakes, llm
+
+
+async def test_consult_writes_blocks_as_they_close(tmp_path):
+    """a headed block is in place before the rest of the reply arrives"""
+    reply = "#### src/a.py\n```python\nx = 1\n```\nand then some more words"
+    completions = fakes.FakeBackend(lambda messages: reply)
+    transcript = []
+    seen = ""
+    early = False
+    async for chunk in chat.consult(completions, "system", str(tmp_path), transcript, "write a"):
+        seen += chunk
+        if seen.count("```") == 2 and not seen.endswith("words"):
+            assert (tmp_path / "src" / "a.py").read_text() == "x = 1\n"
+            early = True
+    assert seen == reply and early
+    assert transcript == [{"role": "user", "content": "write a"}, {"role": "assistant", "content": reply}]
+    assert os.listdir(tmp_path / llm.STAGING_DIR) == []
@@ -0,0 +1,135 @@
+import asyncio
+import json
+
+from agent import fakes, llm
+import server
+from tests import api_fakes
+
+
+def make_server(root, completions, limits=None):
+    return server.Server(str(root), lambda workspace: llm.StatefulChat(
+        system_prompt="",
+        base_path=workspace,
+        completions=completions,
+        sh=fakes.FakeShell(),
+        limits=limits,
+    ))
+
+
+async def test_sessions_stream_responses(tmp_path):
+    """a session streams its response and runs the tools it asks for"""
+    def respond(messages):
+        if len(messages) == 1:
+            return '{"command": "ls_tree"}'
+        return "done"
+
+    completions = fakes.FakeBackend(respond)
+    hosted = make_server(tmp_path, completions)
+    listener = await server.serve(hosted, "127.0.0.1", 0)
+    port = listener.sockets[0].getsockname()[1]
+    async with listener:
+        status, body = await server.fetch("127.0.0.1", port, "POST", "/sessions")
+        assert status == 200
+        session_id = json.loads(body)["id"]
+
+        status, body = await server.fetch("127.0.0.1", port, "POST", f"/sessions/{session_id}/messages", "hi")
+        assert status == 200
+        assert body == '{"command": "ls_tree"}\ndone\n'
+        assert "OBSERVATION: invoked ls_tree" in completions.requests[1][-1]["content"]
+
+        status, _ = await server.fetch("127.0.0.1", port, "POST", "/sessions/nope/messages", "hi")
+        assert status == 404
+
+        status, _ = await server.fetch("127.0.0.1", port, "DELETE", f"/sessions/{session_id}")
+        assert status == 200
+        assert hosted.sessions == {}
+
+
+async def test_model_requests_are_capped(tmp_path):
+    """no more than the configured number of model requests are in flight"""
+    completions = fakes.FakeBackend(lambda messages: "one two three", delay=0.01)
+    hosted = make_server(tmp_path, completions, llm.Limits.create(model_requests=2))
+    sessions = [await hosted.create_session() for _ in range(6)]
+
+    async def turn(session):
+        return "".join([chunk async for chunk in session.chat.interact("hi")])
+
+    results = await asyncio.gather(*(turn(session) for session in sessions))
+    assert results == ["one two three\n"] * 6
+    assert completions.peak_in_flight == 2
+    await hosted.close()
+
+
+async def test_interrupt(tmp_path):
+    """interrupting ends the streamed response and keeps the session"""
+    completions = fakes.FakeBackend(lambda messages: " ".join(["word"] * 50), delay=0.02)
+    hosted = make_server(tmp_path, completions)
+    listener = await server.serve(hosted, "127.0.0.1", 0)
+    port = listener.sockets[0].getsockname()[1]
+    async with listener:
+        status, body = await server.fetch("127.0.0.1", port, "POST", "/sessions")
+        session_id = json.loads(body)["id"]
+
+        turn = asyncio.ensure_future(
+            server.fetch("127.0.0.1", port, "POST", f"/sessions/{session_id}/messages", "hi"),
+        )
+        await asyncio.sleep(0.1)
+        status, body = await server.fetch("127.0.0.1", port, "POST", f"/sessions/{session_id}/interrupt")
+        assert json.loads(body) == {"interrupted": True}
+        status, body = await turn
+        assert status == 200
+        assert body.startswith("word ") and body.endswith(llm.INTERRUPTED + "\n")
+
+        status, body = await server.fetch("127.0.0.1", port, "POST", f"/sessions/{session_id}/interrupt")
+        assert json.loads(body) == {"interrupted": False}
+        await hosted.close()
+
+
+async def test_failed_turn_ends_the_response(tmp_path):
+    """an error from the model is reported in a complete response"""
+    completions = api_fakes.FlakyBackend(fakes.FakeBackend(lambda messages: "one two three"), [(400, 1)])
+    hosted = make_server(tmp_path, completions)
+    listener = await server.serve(hosted, "127.0.0.1", 0)
+    port = listener.sockets[0].getsockname()[1]
+    async with listener:
+        status, body = await server.fetch("127.0.0.1", port, "POST", "/sessions")
+        session_id = json.loads(body)["id"]
+        status, body = await server.fetch("127.0.0.1", port, "POST", f"/sessions/{session_id}/messages", "hi")
+        assert status == 200
+        assert body == "one \n[failed: status 400]\n"
+
+        status, body = await server.fetch("127.0.0.1", port, "POST", f"/sessions/{session_id}/messages", "hi")
+        assert body == "one two three\n"
+        await hosted.close()
+
+
+async def test_malformed_content_length(tmp_path):
+    hosted = make_server(tmp_path, fakes.FakeBackend(lambda messages: "hi"))
+    listener = await server.serve(hosted, "127.0.0.1", 0)
+    port = listener.sockets[0].getsockname()[1]
+    async with listener:
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        writer.write(b"POST /sessions HTTP/1.1\r\nContent-Length: lots\r\n\r\n")
+        response = await reader.read()
+        writer.close()
+        assert response.startswith(b"HTTP/1.1 400 ")
+
+
+async def test_close_interrupts_the_turn(tmp_path):
+    """closing a session doesn't wait for its turn to finish"""
+    completions = fakes.FakeBackend(lambda messages: " ".join(["word"] * 50), delay=0.5)
+    hosted = make_server(tmp_path, completions)
+    listener = await server.serve(hosted, "127.0.0.1", 0)
+    port = listener.sockets[0].getsockname()[1]
+    async with listener:
+        session = await hosted.create_session()
+        turn = asyncio.ensure_future(
+            server.fetch("127.0.0.1", port, "POST", f"/sessions/{session.id}/messages", "hi"),
+        )
+        while not completions.in_flight:
+            await asyncio.sleep(0.01)
+        status, _ = await server.fetch("127.0.0.1", port, "DELETE", f"/sessions/{session.id}")
+        assert status == 200
+        assert completions.in_flight == 0
+        status, body = await turn
+        assert body.endswith(llm.INTERRUPTED + "\n")